@@ -1,12 +1,16 @@
 #!/usr/bin/env python
 
-import requests
+import httpclient
 import urllib
 import re
 import time
 import sys
 import os.path
 import argparse
+import asyncio
+import gzip
+import functools
+import util
 from argparse import RawTextHelpFormatter
 
 help="""
@@ -14,13 +18,46 @@ Performs a blast using NCBI\'s web tool
 
 NOTE: if you are using BLAST+, this tool is obsolete
 Use instead the -remote switch for BLAST+ to perform these searches against NCBIs online database
+
+Blast every sequence of a FASTA file as its own search, 3 at a time, writing blasts/1.blast, blasts/2.blast..
+as soon as each search is done. Files that already exist are not searched again
+    blast.py tblastn tsa_nt queries.fasta --batch blasts -c 3
+
+Results are cached in ~/.cache/blastresults by a hash of the program, database, entrez query and query sequences,
+so repeating a search returns at once. --refresh searches again, --cache-ttl and --cache-size limit the cache
+    blast.py tblastn tsa_nt opsin.fasta --cache-ttl 30 --cache-size 500
+
+In batch mode all requests to NCBI are spaced at least --interval seconds (10 by default, as NCBI asks) apart
+
+Pack short sequences into searches of up to 5000 residues, the results are split back into one file per
+sequence named by its FASTA ID: blasts/opsin1.blast, blasts/opsin2.blast..
+    blast.py tblastn tsa_nt queries.fasta --batch blasts --pack 5000
+
+The result is passed on while it downloads, so the next command can already start on it. A copy can be archived,
+gzip compressed when the name ends in .gz
+    blast.py tblastn tsa_nt opsin.fasta --archive opsin.blast.gz | viewblast.py list -n 5
+
+A single search of several sequences can be split into per sequence files the same way
+    blast.py tblastn tsa_nt queries.fasta --split blasts > all.blast
 """
 
+BLAST_URL = "https://blast.ncbi.nlm.nih.gov/Blast.cgi"
+
 parser = argparse.ArgumentParser(description=help,formatter_class=RawTextHelpFormatter)
 parser.add_argument('program', help='program: blastn blastp blastx tblastn tblastx')
 parser.add_argument('database', help='database: nr refseq_rna refseq_genomic chromosome est gss htgs pat pdb alu dbsts Whole_Genome_Shotgun_contigs tsa_nt rRNA_typestrains/prokaryotic_16S_ribosomal_RNA')
 parser.add_argument('--rid', help='retrieve results for an existing blast by rid')
 parser.add_argument('--entrez', help='an entrez_query to filter results')
+parser.add_argument('--url', default=BLAST_URL, help='the Blast.cgi to use (default: NCBI)')
+parser.add_argument('-b','--batch', metavar="DIR", help='blast each FASTA sequence separately, writing DIR/1.blast, DIR/2.blast..')
+parser.add_argument('-c','--concurrency', type=int, default=3, help='number of searches running at once in batch mode (default: 3)')
+parser.add_argument('-p','--pack', type=int, default=None, help='in batch mode, search as many sequences at once as fit in this many residues')
+parser.add_argument('-a','--archive', metavar="FILE", help='also write the result to FILE, gzip compressed when it ends in .gz')
+parser.add_argument('--split', metavar="DIR", help='also write the result of each query to DIR/<FASTA ID>.blast')
+parser.add_argument('--refresh', action='store_true', help='search again even when the result is cached (and cache the new result)')
+parser.add_argument('--cache-ttl', dest='cacheTtl', type=float, default=None, help='days a cached result stays valid (default: forever)')
+parser.add_argument('--cache-size', dest='cacheSize', type=float, default=None, help='megabytes the result cache may use (default: unlimited)')
+parser.add_argument('--interval', type=float, default=10, help='minimum seconds between requests in batch mode (default: 10)')
 parser.add_argument('fasta', type=argparse.FileType('r'), nargs="?", default=sys.stdin, help='the FASTA sequence(s)')
 
 def extractBlastInfo(responseText):
@@ -31,7 +68,7 @@ def extractBlastInfo(responseText):
             info[mm.group(1)] = mm.group(2);
     return info;
 
-def startBlast(program,database,entrez,query):
+def startBlast(program,database,entrez,query,url=BLAST_URL):
     params = {
         "CMD" : "Put",
         "PROGRAM" : program,
@@ -42,47 +79,312 @@ def startBlast(program,database,entrez,query):
     if (entrez):
         params["ENTREZ_QUERY"] = entrez;
 
-    r = requests.post("https://blast.ncbi.nlm.nih.gov/Blast.cgi",params=params);
+    r = httpclient.post(url,params=params);
     info = extractBlastInfo(r.text);
-    return info['RID'], int(info['RTOE']);
+    if ("RID" not in info): raise ValueError("no RID in the response to the search request (HTTP %d)" % r.status_code);
+    return info['RID'], int(info.get('RTOE',0));
+
+def searchStatus(rid,url=BLAST_URL):
+    r = httpclient.get(url,params={"CMD":"Get","FORMAT_OBJECT":"SearchInfo","RID":rid});
+    return extractBlastInfo(r.text)["Status"];
 
-def waitForCompletion(rid):
+def pollDelay(i):
+    "Seconds to wait before the i-th status check after the estimated time"
+    sleeptime = 5*i;
+    if (sleeptime > 30): sleeptime = 30;
+    return sleeptime;
+
+def waitForCompletion(rid,url=BLAST_URL):
     i = 0;
     while(True):
-        r = requests.get("https://www.ncbi.nlm.nih.gov/blast/Blast.cgi?CMD=Get&FORMAT_OBJECT=SearchInfo&RID=%s" % rid);
-        info = extractBlastInfo(r.text);
-        status = info["Status"]
+        status = searchStatus(rid,url);
         if (status == "READY"): return True;
         if (status == "FAILED"): return False;
         if (status == "UNKNOWN"): return False;
 
         i += 1
-        sleeptime = 5*i;
-        if (sleeptime > 30): sleeptime = 30;
-        time.sleep(sleeptime);
+        time.sleep(pollDelay(i));
 
-def getResults(rid):
-    r = requests.get("https://www.ncbi.nlm.nih.gov/blast/Blast.cgi?CMD=Get&FORMAT_TYPE=XML&RID=%s" % rid);
+def getResults(rid,url=BLAST_URL):
+    r = httpclient.get(url,params={"CMD":"Get","FORMAT_TYPE":"XML","RID":rid});
     return r.text;
 
+#bytes per chunk of a streamed result
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def resultChunks(rid,url=BLAST_URL):
+    "The XML result of rid as it downloads, in chunks of bytes"
+    with httpclient.get(url,params={"CMD":"Get","FORMAT_TYPE":"XML","RID":rid},stream=True) as r:
+        for chunk in r.iter_content(STREAM_CHUNK_SIZE):
+            yield chunk;
+
+def fileChunks(path):
+    with open(path,"rb") as f:
+        for chunk in iter(functools.partial(f.read,STREAM_CHUNK_SIZE),b""):
+            yield chunk;
+
+class StrippedOutput:
+    """
+    Writes chunks to a binary stream the way print(text.strip()) writes the whole text: without leading or trailing
+    whitespace and with a newline at the end. Each chunk is flushed so a reader can start before the end, and a reader
+    that stops early (a closed pipe) doesn't stop the download
+    """
+    def __init__(self,stream):
+        self.stream = stream;
+        self.started = False;
+        self.pending = b"";
+        self.closed = False;
+
+    def write(self,chunk):
+        if (not self.started):
+            chunk = chunk.lstrip();
+            if (not chunk): return;
+            self.started = True;
+        body = chunk.rstrip();
+        if (not body):
+            self.pending += chunk;
+            return;
+        self.send(self.pending + body);
+        self.pending = chunk[len(body):];
+
+    def send(self,data):
+        if (self.closed): return;
+        try:
+            self.stream.write(data);
+            self.stream.flush();
+        except BrokenPipeError:
+            self.closed = True;
+
+    def close(self):
+        self.send(b"\n");
+
+def resultCache(args):
+    return util.ResultCache(ttl=args.cacheTtl * 86400 if args.cacheTtl is not None else None,
+                            maxSize=int(args.cacheSize * 1024 * 1024) if args.cacheSize is not None else None);
+
+def searchKey(args,query):
+    return util.ResultCache.key("blast",args.url,args.program,args.database,args.entrez,util.normalizeQuery(query));
+
+def fastaRecords(text):
+    return [record for record in re.split(r"\n(?=>)",text.strip()) if record.strip()];
+
+def recordId(record):
+    words = record.split("\n",1)[0].lstrip(">").split();
+    return words[0] if words else "";
+
+def resultFileNames(records):
+    "A unique file name per record from its FASTA ID"
+    names = [];
+    used = set();
+    for number,record in enumerate(records,1):
+        name = re.sub(r"[^\w.-]","_",recordId(record)) or str(number);
+        if (name in used): name = "%s_%d" % (name,number);
+        used.add(name);
+        names.append(name + ".blast");
+    return names;
+
+def residueCount(record):
+    return len(re.sub(r"\s","",record.split("\n",1)[1])) if "\n" in record else 0;
+
+def packRecords(records,length):
+    "Groups consecutive records into packs of at most length residues (a longer record is a pack of its own) as lists of indices"
+    packs = [];
+    size = 0;
+    for i,record in enumerate(records):
+        residues = residueCount(record);
+        if (packs and size + residues <= length):
+            packs[-1].append(i);
+            size += residues;
+        else:
+            packs.append([i]);
+            size = residues;
+    return packs;
+
+def splitResults(results):
+    """
+    Splits a multi-query XML result into one XML document per query (Iteration), in order
+    Each keeps the header and footer of the original with the BlastOutput_query-* fields of its own query
+    """
+    iterations = [m for m in re.finditer(r"<Iteration>.*?</Iteration>",results,re.DOTALL)];
+    if (len(iterations) == 0): return [results];
+    head = results[:iterations[0].start()];
+    tail = results[iterations[-1].end():];
+    documents = [];
+    for m in iterations:
+        iteration = m.group(0);
+        header = head;
+        for field in ("query-ID","query-def","query-len"):
+            value = re.search(r"<Iteration_%s>(.*?)</Iteration_%s>" % (field,field),iteration,re.DOTALL);
+            if (value):
+                header = re.sub(r"<BlastOutput_%s>.*?</BlastOutput_%s>" % (field,field),
+                                lambda _: "<BlastOutput_%s>%s</BlastOutput_%s>" % (field,value.group(1),field),header,flags=re.DOTALL);
+        documents.append(header + iteration + tail);
+    return documents;
+
+def writeResult(path,results):
+    with open(path + ".tmp","w") as f:
+        f.write(results);
+    os.replace(path + ".tmp",path);
+
+def writeSplitResults(results,records,paths):
+    """
+    Writes the result of each query of a search of records to the matching path
+    Queries are matched to records on the FASTA ID of their definition, and else on their order
+    Returns the paths that were written
+    """
+    documents = splitResults(results) if len(records) > 1 else [results];
+    ids = [recordId(record) for record in records];
+    written = [];
+    for i,document in enumerate(documents):
+        definition = re.search(r"<Iteration_query-def>(.*?)</Iteration_query-def>",document,re.DOTALL);
+        queryId = definition.group(1).split()[0] if definition and definition.group(1).split() else None;
+        index = i if (i < len(ids) and ids[i] == queryId) or queryId not in ids else ids.index(queryId);
+        if (index >= len(paths)): continue;
+        writeResult(paths[index],document);
+        written.append(paths[index]);
+    return written;
+
+class RequestScheduler:
+    """
+    Runs the blocking requests of all batch searches in threads, starting them at least interval seconds apart,
+    so however many searches are waiting the server sees one steady stream of requests. Only the start is spaced,
+    a long download doesn't hold up the status checks of the other searches
+    """
+    def __init__(self,interval):
+        self.interval = interval;
+        self.lock = asyncio.Lock();
+        self.last = None;
+
+    async def call(self,function,*args):
+        async with self.lock:
+            if (self.last is not None):
+                wait = self.last + self.interval - time.monotonic();
+                if (wait > 0): await asyncio.sleep(wait);
+            self.last = time.monotonic();
+        return await asyncio.get_running_loop().run_in_executor(None,function,*args);
+
+async def batchSearch(args,scheduler,slots,cache,number,records,paths):
+    """
+    Runs one search of the records of a batch and writes the result of each to its path, returns whether it succeeded
+    An error is reported and fails only this search, the other searches of the batch carry on
+    """
+    try:
+        return await runBatchSearch(args,scheduler,slots,cache,number,records,paths);
+    except Exception as e:
+        sys.stderr.write("[%d] failed: %s: %s\n" % (number,type(e).__name__,e));
+        return False;
+
+async def runBatchSearch(args,scheduler,slots,cache,number,records,paths):
+    query = "\n".join(records);
+    key = searchKey(args,query);
+    results = None if args.refresh else cache.get(key);
+    if (results is not None):
+        sys.stderr.write("[%d] cached\n" % number);
+        return writeBatchResults(number,"cache",results,records,paths);
+    async with slots:
+        rid,rtoe = await scheduler.call(startBlast,args.program,args.database,args.entrez,query,args.url);
+        rid = rid.strip();
+        sys.stderr.write("[%d] RID: %s, estimated time: %d seconds\n" % (number,rid,rtoe));
+        await asyncio.sleep(rtoe);
+        i = 0;
+        while(True):
+            status = await scheduler.call(searchStatus,rid,args.url);
+            if (status == "READY"): break;
+            if (status in ("FAILED","UNKNOWN")):
+                sys.stderr.write("[%d] RID %s: %s\n" % (number,rid,status));
+                return False;
+            i += 1
+            await asyncio.sleep(pollDelay(i));
+        results = await scheduler.call(getResults,rid,args.url);
+    if (not util.isBlastXml(results)):
+        sys.stderr.write("[%d] RID %s: the result isn't blast XML\n" % (number,rid));
+        return False;
+    cache.put(key,results);
+    return writeBatchResults(number,"RID " + rid,results,records,paths);
+
+def writeBatchResults(number,source,results,records,paths):
+    written = writeSplitResults(results,records,paths);
+    for path in written:
+        sys.stderr.write("[%d] %s\n" % (number,path));
+    if (len(written) < len(paths)):
+        sys.stderr.write("[%d] %s: %d of %d queries missing from the results\n" % (number,source,len(paths) - len(written),len(paths)));
+    return len(written) == len(paths);
+
+async def batch(args,records):
+    os.makedirs(args.batch,exist_ok=True);
+    scheduler = RequestScheduler(args.interval);
+    slots = asyncio.Semaphore(max(1,args.concurrency));
+    cache = resultCache(args);
+    if (args.pack):
+        names = resultFileNames(records);
+    else:
+        names = ["%d.blast" % number for number in range(1,len(records) + 1)];
+    todo = [];
+    for number,(record,name) in enumerate(zip(records,names),1):
+        path = os.path.join(args.batch,name);
+        if (os.path.exists(path)): continue;
+        todo.append((number,record,path));
+    packs = packRecords([record for number,record,path in todo],args.pack) if args.pack else [[i] for i in range(len(todo))];
+    searches = [batchSearch(args,scheduler,slots,cache,todo[pack[0]][0],[todo[i][1] for i in pack],[todo[i][2] for i in pack]) for pack in packs];
+    done = await asyncio.gather(*searches);
+    return all(done);
+
 def main():
     args = parser.parse_args()
 
+    if (args.batch):
+        ok = asyncio.run(batch(args,fastaRecords(args.fasta.read())));
+        sys.exit(0 if ok else 1);
+
+    cache = resultCache(args);
+    key = None;
+    cached = None;
     if (not args.rid):
         fasta = args.fasta.read()
         sys.stderr.write("Program: %s\nDatabase: %s\nEntrez: %s\nQuery: \n%s" % (args.program,args.database,args.entrez,fasta));
-        rid,rtoe = startBlast(args.program,args.database,args.entrez,fasta);
+        key = searchKey(args,fasta);
+        cached = None if args.refresh else cache.getPath(key);
+    if (cached is not None):
+        rid = None;
+        sys.stderr.write("Cached result\n");
+        chunks = fileChunks(cached);
+    elif (not args.rid):
+        rid,rtoe = startBlast(args.program,args.database,args.entrez,fasta,args.url);
         rid = rid.strip()
         sys.stderr.write("RID: %s\n" % rid);
         sys.stderr.write("Estimated time: %d seconds\n" % rtoe);
         time.sleep(rtoe);
-        waitForCompletion(rid);
+        if (not waitForCompletion(rid,args.url)):
+            sys.stderr.write("RID %s: the search failed\n" % rid);
+            sys.exit(1);
+        chunks = resultChunks(rid,args.url);
     else:
         rid = args.rid;
-    results = getResults(rid)
-    with open("_latest.blast","w") as f:
-        f.write(results);
-    print(results.strip());
-    sys.stderr.write("View in browser: https://www.ncbi.nlm.nih.gov/blast/Blast.cgi?CMD=Get&FORMAT_TYPE=HTML&RID=%s\n" % rid);
+        chunks = resultChunks(rid,args.url);
+
+    #each chunk goes to every output as it arrives instead of holding the whole result
+    outputs = [open("_latest.blast","wb")];
+    if (args.archive): outputs.append(gzip.open(args.archive,"wb") if args.archive.endswith(".gz") else open(args.archive,"wb"));
+    stdout = StrippedOutput(sys.stdout.buffer);
+    try:
+        for chunk in chunks:
+            for out in outputs:
+                out.write(chunk);
+            stdout.write(chunk);
+    finally:
+        for out in outputs:
+            out.close();
+    stdout.close();
+
+    #only a complete result of a finished search is worth keeping
+    if (cached is None and key is not None and util.isBlastXmlFile("_latest.blast")): cache.putFile(key,"_latest.blast");
+    if (args.split and not args.rid):
+        with open("_latest.blast") as f:
+            results = f.read();
+        records = fastaRecords(fasta);
+        os.makedirs(args.split,exist_ok=True);
+        writeSplitResults(results,records,[os.path.join(args.split,name) for name in resultFileNames(records)]);
+    if (rid): sys.stderr.write("View in browser: %s?%s\n" % (args.url,urllib.parse.urlencode({"CMD":"Get","FORMAT_TYPE":"HTML","RID":rid})));
 
-main();
+if __name__ == "__main__":
+    main();
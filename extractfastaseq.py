@@ -1,6 +1,15 @@
 #!/usr/bin/env python
 import sys
+import os
+import io
+import gzip
+import zlib
+import bisect
+import mmap
+import multiprocessing
 import argparse
+import collections
+import util
 from argparse import RawTextHelpFormatter
 
 help="""
@@ -9,19 +18,43 @@ Extracts sequences from a fasta file
 Outputs a single fasta entry with the header that contains a string
     extractfastaseq.py input.fasta TR3733
 
+Outputs every entry whose header contains one of the strings listed (one per line) in accessions.txt
+in a single pass over the file. Strings that are not found are reported on stderr
+    extractfastaseq.py input.fasta -b accessions.txt
+
+Same as above but matching the ID (the first word of the header) exactly, in the order of accessions.txt
+    cat accessions.txt | extractfastaseq.py input.fasta -b - --exact --order input
+
 Outputs the first fasta sequence in the file
     extractfastaseq.py input.fasta -n 1
 
 Outputs all entries EXCEPT the first fasta sequence in the file
+(the remaining entries are copied byte for byte, keeping their original line wrapping)
     extractfastaseq.py input.fasta -r 1
 
-Outputs the number of fasta sequences in the given file (may take time to run on large files)
+Outputs the number of fasta sequences in the given file
+(large files are split into chunks that are counted in parallel, one worker per core)
     extractfastaseq.py input.fasta -c
 
+Same as above using only 4 worker processes
+    extractfastaseq.py input.fasta -c -j 4
+
 Outputs one fasta entry per line with "###" delimiting the header from the sequence
 eg: >TR3733|c0_g1_i5len=6587path=[###MDDSRVGSPNGSLDGGVI..
     extractfastaseq.py input.fasta -l
 
+The first lookup by accession or index on a file builds a sidecar index (input.fasta.xfai)
+that later lookups use to seek straight to the record. The index is rebuilt automatically
+when the fasta file changes. To skip the index entirely:
+    extractfastaseq.py input.fasta TR3733 --noindex
+
+Gzip compressed files (and piped gzip data) are read directly, no need to zcat them first
+    extractfastaseq.py input.fasta.gz -c
+
+Files compressed with bgzip (BGZF, eg: bgzip input.fasta) also get a block index (input.fasta.gz.xgzi)
+so lookups by accession or index only decompress the blocks that hold the record
+    extractfastaseq.py input.fasta.gz TR3733
+
 Iterates over each fasta sequence in your file
     extractfastaseq.py input.fasta -l | while read line
     do
@@ -46,41 +79,449 @@ parser.add_argument('-n', dest="extractByIndex", type=int, default=None,help='Re
 parser.add_argument('-r', dest="removeByIndex", type=int, default=None,help='Returns a fasta file with one of the sequences removed')
 parser.add_argument('-c', dest="count", action="store_const", const=True, default=False,help='Return the number of sequences in the fasta file')
 parser.add_argument('-l', dest="list", action="store_const", const=True, default=False,help='List the fasta output one per line: [header]###[sequence]')
+parser.add_argument('-b', '--batch', type=argparse.FileType('r'), default=None,help='Extract every accession listed (one per line) in this file, - for stdin')
+parser.add_argument('--exact', action="store_const", const=True, default=False,help='With -b, match the header ID exactly instead of as a substring')
+parser.add_argument('--order', choices=["file","input"], default="file",help='With -b, output in the order of the fasta file (default) or of the accession list')
+parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,help='Number of worker processes used by -c and -l on large files (default: number of cores, stdin is always serial)')
+parser.add_argument('--noindex', dest="useIndex", action="store_const", const=False, default=True,help='Do not build or use the sidecar offset index')
 
 def nth(iterable, n, default=None):
     "Returns the nth item or a default value"
     return next(islice(iterable, n, None), default)
 
 def fasta(f):
-    i = 0;
     accum = None;
     for line in f:
         line = line.strip()
-        i+=1;
         if (line.startswith(">")):
             if (accum is not None):
-                yield accum;
-            accum = (line,"");
+                yield (accum[0],"".join(accum[1]));
+            accum = (line,[]);
             continue;
         if (accum is not None):
-            accum = (accum[0],accum[1]+line);
+            accum[1].append(line);
+
+    if (accum is not None): yield (accum[0],"".join(accum[1]));
+
+class MappedFasta:
+    """
+    Read only view of a fasta file through mmap
+
+    Records are (start,seqStart,end) byte ranges into the mapping: start is the ">" of the header,
+    seqStart the first byte after the header line and end the start of the next record.
+    Nothing is copied until a header or sequence is asked for.
+    """
+    def __init__(self,path):
+        self.file = open(path,"rb");
+        self.size = os.fstat(self.file.fileno()).st_size;
+        self.map = mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ) if self.size else b"";
+
+    def close(self):
+        if (self.size): self.map.close();
+        self.file.close();
+
+    def __enter__(self):
+        return self;
+
+    def __exit__(self,*exc):
+        self.close();
+
+    def records(self,start=0,stop=None):
+        "Yields the records that start in [start,stop), start must be 0 or the start of a record"
+        mm = self.map;
+        stop = self.size if stop is None else stop;
+        if (start > 0 or mm[:1] == b">"):
+            pos = start;
+        else:
+            pos = mm.find(b"\n>") + 1;
+            if (pos == 0): return;
+        while (pos < stop):
+            lineEnd = mm.find(b"\n",pos);
+            if (lineEnd == -1):
+                yield (pos,self.size,self.size);
+                return;
+            end = mm.find(b"\n>",lineEnd);
+            end = self.size if end == -1 else end + 1;
+            yield (pos,lineEnd + 1,end);
+            pos = end;
+
+    def nth(self,n):
+        "Returns the nth record (starting at 1) or None"
+        for i,rec in enumerate(self.records()):
+            if (i + 1 == n): return rec;
+        return None;
+
+    def header(self,rec):
+        return self.map[rec[0]:rec[1]].strip();
+
+    def sequence(self,rec):
+        return self.map[rec[1]:rec[2]].translate(None,b" \t\r\n");
+
+    def writeRecord(self,out,rec,separator=b"\n"):
+        out.write(self.header(rec) + separator + self.sequence(rec) + b"\n");
+
+    def chunks(self,count):
+        "Splits the file into at most count byte ranges that each start on a record boundary"
+        bounds = [0];
+        for i in range(1,count):
+            pos = self.map.find(b"\n>",max(bounds[-1],self.size * i // count));
+            if (pos == -1): break;
+            if (pos + 1 > bounds[-1]): bounds.append(pos + 1);
+        bounds.append(self.size);
+        return [(bounds[i],bounds[i+1]) for i in range(len(bounds) - 1)];
+
+    def copyRange(self,out,start,end):
+        "Copies bytes [start,end) of the file to the binary stream out, using sendfile where the platform allows"
+        out.flush();
+        try:
+            fd = out.fileno();
+            while (start < end):
+                sent = os.sendfile(fd,self.file.fileno(),start,end - start);
+                if (sent == 0): break;
+                start += sent;
+        except (AttributeError,OSError,io.UnsupportedOperation):
+            pass #no sendfile for this kind of output, copy the rest through the mapping
+        if (start < end):
+            out.write(memoryview(self.map)[start:end]);
+
+#one record per line of the sidecar index, offsets are in bytes from the start of the file
+#header and seqOffset point at the ">" line and the first sequence line, end at the next record
+IndexEntry = collections.namedtuple("IndexEntry",["id","length","offset","seqOffset","end","lineBases","lineWidth","header"])
+INDEX_SUFFIX = ".xfai"
+INDEX_MAGIC = "#xfai"
+
+def indexPath(path):
+    return path + INDEX_SUFFIX
+
+def fileSignature(path):
+    st = os.stat(path)
+    return "%d\t%d" % (st.st_size,st.st_mtime_ns)
+
+def headerId(header):
+    return header[1:].split(None,1)[0] if len(header) > 1 else ""
+
+def buildIndexFromLines(f):
+    "Builds the index entries from a binary line stream, offsets are positions in the (uncompressed) stream"
+    entries = [];
+    current = None;
+
+    def finish(current,end):
+        header,offset,seqOffset,length,lineBases,lineWidth = current
+        return IndexEntry(headerId(header),length,offset,seqOffset,end,lineBases,lineWidth,header)
+
+    offset = 0;
+    for line in f:
+        if (line.startswith(b">")):
+            if (current is not None):
+                entries.append(finish(current,offset));
+            current = [line.strip().decode("latin-1"),offset,offset+len(line),0,0,0];
+        elif (current is not None):
+            bases = len(line.strip());
+            if (current[4] == 0 and bases):
+                current[4] = bases;
+                current[5] = len(line);
+            current[3] += bases;
+        offset += len(line);
+    if (current is not None): entries.append(finish(current,offset));
+    return entries;
+
+def buildIndex(path):
+    if (gzipKind(path) is not None):
+        with gzip.open(path,"rb") as f:
+            return buildIndexFromLines(f);
+    entries = [];
+    with MappedFasta(path) as mapped:
+        mm = mapped.map;
+        for rec in mapped.records():
+            start,seqStart,end = rec;
+            header = mapped.header(rec).decode("latin-1");
+            lineEnd = mm.find(b"\n",seqStart,end);
+            lineWidth = (lineEnd if lineEnd != -1 else end) - seqStart + (1 if lineEnd != -1 else 0);
+            lineBases = len(mm[seqStart:seqStart + lineWidth].strip());
+            length = len(mapped.sequence(rec));
+            entries.append(IndexEntry(headerId(header),length,start,seqStart,end,lineBases,lineWidth if lineBases else 0,header));
+    return entries;
 
-    if (accum is not None): yield accum;
+def writeIndex(path,entries):
+    tmp = indexPath(path) + ".tmp"
+    with open(tmp,"w",encoding="latin-1") as f:
+        f.write("%s\t%s\n" % (INDEX_MAGIC,fileSignature(path)));
+        for e in entries:
+            f.write("%s\t%d\t%d\t%d\t%d\t%d\t%d\t%s\n" % e);
+    os.replace(tmp,indexPath(path));
+
+def loadIndex(path):
+    "Returns the index entries for path or None if there is no index or it is out of date"
+    try:
+        with open(indexPath(path),encoding="latin-1") as f:
+            signature = f.readline().rstrip("\n").split("\t",1)
+            if (signature[0] != INDEX_MAGIC or len(signature) != 2 or signature[1] != fileSignature(path)):
+                return None;
+            entries = [];
+            for line in f:
+                fields = line.rstrip("\n").split("\t",7)
+                entries.append(IndexEntry(fields[0],*[int(v) for v in fields[1:7]],fields[7]));
+            return entries;
+    except (OSError,ValueError,IndexError):
+        return None;
+
+def getIndex(path):
+    "Loads the sidecar index for path, building (and saving when possible) a new one if it is missing or stale"
+    entries = loadIndex(path);
+    if (entries is not None): return entries;
+    entries = buildIndex(path);
+    try:
+        writeIndex(path,entries);
+    except OSError:
+        pass #read only location, use the index for this run only
+    return entries;
+
+def entryRecord(entry):
+    return (entry.offset,entry.seqOffset,entry.end);
+
+def readPatterns(f):
+    patterns = [];
+    seen = set();
+    for line in f:
+        line = line.strip();
+        if (line and line not in seen):
+            seen.add(line);
+            patterns.append(line);
+    return patterns;
+
+def batchMatches(patterns,records,exact):
+    """
+    Matches many accessions against (header,record) pairs in one pass, yielding (patternIndices,record)
+    for every record that is the first match of at least one pattern. Exact matching looks the header ID
+    up in a hash table, substring matching runs all the patterns at once through an Aho-Corasick automaton
+    """
+    if (exact):
+        byId = {};
+        for i,pattern in enumerate(patterns): byId.setdefault(pattern,[]).append(i);
+        match = lambda header: byId.get(headerId(header),());
+    else:
+        automaton = util.AhoCorasick(patterns);
+        match = automaton.search;
+    remaining = set(range(len(patterns)));
+    for header,rec in records:
+        if (not remaining): return;
+        hits = [i for i in match(header) if i in remaining];
+        if (hits):
+            remaining.difference_update(hits);
+            yield hits,rec;
+
+def gzipKind(path):
+    "Returns None for uncompressed files, \"bgzf\" for blocked gzip (bgzip) files and \"gzip\" for any other gzip file"
+    with open(path,"rb") as f:
+        head = f.read(18);
+    return headerKind(head);
+
+def headerKind(head):
+    if (head[:2] != b"\x1f\x8b"): return None;
+    #BGZF blocks carry a "BC" extra subfield holding the compressed block size
+    if (len(head) >= 18 and head[3] & 4 and head[12:14] == b"BC"): return "bgzf";
+    return "gzip";
+
+BLOCK_INDEX_SUFFIX = ".xgzi"
+
+def scanBlocks(path):
+    "Returns the (compressed offset,uncompressed offset) of every BGZF block, reading only the block headers and trailers"
+    blocks = [];
+    coffset = 0;
+    uoffset = 0;
+    with open(path,"rb") as f:
+        while (True):
+            f.seek(coffset);
+            head = f.read(18);
+            if (len(head) < 18): break;
+            if (headerKind(head) != "bgzf"): raise ValueError("%s: not a BGZF block at offset %d" % (path,coffset));
+            bsize = int.from_bytes(head[16:18],"little") + 1;
+            f.seek(coffset + bsize - 4);
+            isize = int.from_bytes(f.read(4),"little");
+            blocks.append((coffset,uoffset));
+            coffset += bsize;
+            uoffset += isize;
+    return blocks;
+
+def loadBlocks(path):
+    try:
+        with open(path + BLOCK_INDEX_SUFFIX) as f:
+            signature = f.readline().rstrip("\n").split("\t",1)
+            if (signature[0] != INDEX_MAGIC or len(signature) != 2 or signature[1] != fileSignature(path)):
+                return None;
+            return [tuple(int(v) for v in line.split("\t")) for line in f];
+    except (OSError,ValueError):
+        return None;
+
+def getBlocks(path):
+    blocks = loadBlocks(path);
+    if (blocks is not None): return blocks;
+    blocks = scanBlocks(path);
+    try:
+        tmp = path + BLOCK_INDEX_SUFFIX + ".tmp";
+        with open(tmp,"w") as f:
+            f.write("%s\t%s\n" % (INDEX_MAGIC,fileSignature(path)));
+            for block in blocks: f.write("%d\t%d\n" % block);
+        os.replace(tmp,path + BLOCK_INDEX_SUFFIX);
+    except OSError:
+        pass
+    return blocks;
+
+class BgzfFasta:
+    """
+    Random access to a BGZF compressed fasta file through its block index
+
+    Records are (start,seqStart,end) offsets into the uncompressed data, as stored in the sidecar index,
+    reading one only decompresses the blocks it spans.
+    """
+    def __init__(self,path):
+        self.file = open(path,"rb");
+        self.blocks = getBlocks(path);
+        self.starts = [u for c,u in self.blocks];
+
+    def close(self):
+        self.file.close();
+
+    def read(self,start,end):
+        i = max(bisect.bisect_right(self.starts,start) - 1,0);
+        parts = [];
+        first = self.starts[i] if self.blocks else 0;
+        covered = first;
+        while (i < len(self.blocks) and covered < end):
+            coffset = self.blocks[i][0];
+            nextOffset = self.blocks[i+1][0] if i + 1 < len(self.blocks) else None;
+            self.file.seek(coffset);
+            raw = self.file.read(nextOffset - coffset) if nextOffset is not None else self.file.read();
+            data = zlib.decompress(raw,16 + zlib.MAX_WBITS);
+            parts.append(data);
+            covered += len(data);
+            i += 1;
+        return b"".join(parts)[start - first:end - first];
+
+    def header(self,rec):
+        return self.read(rec[0],rec[1]).strip();
+
+    def sequence(self,rec):
+        return self.read(rec[1],rec[2]).translate(None,b" \t\r\n");
+
+    def writeRecord(self,out,rec,separator=b"\n"):
+        data = self.read(rec[0],rec[2]);
+        split = rec[1] - rec[0];
+        out.write(data[:split].strip() + separator + data[split:].translate(None,b" \t\r\n") + b"\n");
+
+def openCompressed(f):
+    "Wraps a text mode file (or stdin) holding gzip data in a decompressing text stream, other files are returned unchanged"
+    buffer = getattr(f,"buffer",None);
+    if (buffer is None or not hasattr(buffer,"peek")): return f;
+    if (headerKind(buffer.peek(2)[:2]) is None): return f;
+    encoding = f.encoding;
+    return io.TextIOWrapper(gzip.GzipFile(fileobj=f.detach()),encoding=encoding);
+
+#target size of the byte ranges handed to worker processes by -c and -l
+CHUNK_SIZE = 32 * 1024 * 1024
+
+def countChunk(task):
+    path,start,stop = task;
+    with MappedFasta(path) as mapped:
+        return sum(1 for rec in mapped.records(start,stop));
+
+def listChunk(task):
+    path,start,stop = task;
+    with MappedFasta(path) as mapped:
+        return b"".join(mapped.header(rec) + b"###" + mapped.sequence(rec) + b"\n" for rec in mapped.records(start,stop));
+
+def mapChunks(func,mapped,path,jobs):
+    "Runs func over record aligned chunks of the file in a process pool, yielding the results in file order"
+    ranges = mapped.chunks(max(jobs,mapped.size // CHUNK_SIZE + 1));
+    tasks = [(path,start,stop) for start,stop in ranges];
+    if (jobs <= 1 or len(tasks) <= 1):
+        for task in tasks: yield func(task);
+        return;
+    with multiprocessing.Pool(min(jobs,len(tasks))) as pool:
+        for result in pool.imap(func,tasks):
+            yield result;
+
+def lookupRecords(f,ids,useIndex=True):
+    """
+    Yields (id,header,sequence) for the records whose header ID is in ids, in file order
+    Regular and BGZF files are looked up through the sidecar index, anything else is read in a single pass
+    that stops once every ID has been found
+    """
+    remaining = set(ids);
+    path = f.name if indexable(f) else None;
+    compression = gzipKind(path) if path is not None else None;
+    if (useIndex and path is not None and compression != "gzip"):
+        reader = MappedFasta(path) if compression is None else BgzfFasta(path);
+        try:
+            for entry in getIndex(path):
+                if (not remaining): return;
+                if (entry.id in remaining):
+                    remaining.discard(entry.id);
+                    yield entry.id, entry.header, reader.sequence(entryRecord(entry)).decode("latin-1");
+        finally:
+            reader.close();
+        return;
+    for head,seq in fasta(openCompressed(f)):
+        if (not remaining): return;
+        id = headerId(head);
+        if (id in remaining):
+            remaining.discard(id);
+            yield id, head, seq;
+
+def indexable(f):
+    return f is not None and f is not sys.stdin and os.path.isfile(getattr(f,"name",""));
 
 
 def main():
     args = parser.parse_args()
+    path = args.fasta.name if indexable(args.fasta) else None
+    compression = gzipKind(path) if path is not None else None
+    mapped = MappedFasta(path) if (path is not None and compression is None) else None
+    blocked = BgzfFasta(path) if (compression == "bgzf" and args.useIndex) else None
+    args.fasta = openCompressed(args.fasta)
+    #random access reader for index lookups
+    reader = mapped if mapped is not None else blocked
+    useIndex = args.useIndex and reader is not None
+    #listing and counting walk the whole file anyway (and removal can only seek in uncompressed files), only lookups build the index
+    needIndex = not (args.list or args.count or (args.removeByIndex and mapped is None))
+    index = getIndex(path) if (useIndex and needIndex) else None
+    out = sys.stdout.buffer
     if (args.list):
+        if (mapped is not None):
+            for chunk in mapChunks(listChunk,mapped,path,args.jobs):
+                out.write(chunk);
+            sys.exit(0)
         for head,seq in fasta(args.fasta):
             print("%s###%s" % (head,seq));
         sys.exit(0)
     if (args.count):
+        index = loadIndex(path) if useIndex else None
+        if (index is not None):
+            print(len(index));
+            sys.exit(0)
+        if (mapped is not None):
+            print(sum(mapChunks(countChunk,mapped,path,args.jobs)));
+            sys.exit(0)
         i=1
         for head,seq in fasta(args.fasta):
             i+=1
         print(i-1)
         sys.exit(0)
     if (args.removeByIndex):
+        if (mapped is not None):
+            #copy the untouched bytes around the removed record straight from the file
+            if (index is not None):
+                first = index[0].offset if len(index) else mapped.size
+                removed = entryRecord(index[args.removeByIndex-1]) if 0 < args.removeByIndex <= len(index) else None
+            else:
+                first = next(mapped.records(),(mapped.size,))[0]
+                removed = mapped.nth(args.removeByIndex)
+            if (removed is None):
+                mapped.copyRange(out,first,mapped.size);
+            else:
+                mapped.copyRange(out,first,removed[0]);
+                mapped.copyRange(out,removed[2],mapped.size);
+            sys.exit(0)
         i=1
         for head,seq in fasta(args.fasta):
             if (i != args.removeByIndex):
@@ -88,17 +529,65 @@ def main():
             i+=1
         sys.exit(0)
     if (args.extractByIndex):
+        if (index is not None):
+            if (0 < args.extractByIndex <= len(index)):
+                reader.writeRecord(out,entryRecord(index[args.extractByIndex-1]));
+            sys.exit(0)
+        if (mapped is not None):
+            rec = mapped.nth(args.extractByIndex)
+            if (rec is not None): mapped.writeRecord(out,rec);
+            sys.exit(0)
         i=1
         for head,seq in fasta(args.fasta):
             if (i == args.extractByIndex):
                 print("%s\n%s" % (head,seq));
                 sys.exit(0)
             i+=1
+    if (args.batch):
+        patterns = readPatterns(args.batch);
+        if (index is not None):
+            records = ((entry.header,entryRecord(entry)) for entry in index);
+            emit = lambda rec: reader.writeRecord(out,rec);
+        elif (mapped is not None):
+            records = ((mapped.header(rec).decode("latin-1"),rec) for rec in mapped.records());
+            emit = lambda rec: mapped.writeRecord(out,rec);
+        else:
+            records = ((head,(head,seq)) for head,seq in fasta(args.fasta));
+            emit = lambda rec: print("%s\n%s" % rec);
+
+        found = {};
+        for hits,rec in batchMatches(patterns,records,args.exact):
+            for i in hits: found[i] = rec;
+            if (args.order == "file"): emit(rec);
+        if (args.order == "input"):
+            emitted = set();
+            for i in range(len(patterns)):
+                rec = found.get(i);
+                if (rec is not None and rec not in emitted):
+                    emitted.add(rec);
+                    emit(rec);
+        sys.stdout.flush();
+        for i,pattern in enumerate(patterns):
+            if (i not in found): sys.stderr.write("Not found: %s\n" % pattern);
+        sys.exit(0)
     if (args.accession):
         accession = args.accession
         if not isinstance(accession,str):
             accession = accession.read()
         accession = accession.strip()
+        if (index is not None):
+            for entry in index:
+                if (accession in entry.header):
+                    reader.writeRecord(out,entryRecord(entry));
+                    sys.exit(0)
+            sys.exit(0)
+        if (mapped is not None):
+            needle = accession.encode("latin-1")
+            for rec in mapped.records():
+                if (needle in mapped.header(rec)):
+                    mapped.writeRecord(out,rec);
+                    sys.exit(0)
+            sys.exit(0)
         for head,seq in fasta(args.fasta):
             if (accession in head):
                 print("%s\n%s" % (head,seq));
@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-import requests
+import httpclient
 import sys
 import time
 import argparse
@@ -30,10 +30,8 @@ parser.add_argument("accession", nargs='?', default=sys.stdin, action=StreamType
 args = parser.parse_args()
 
 def fetchContig(accession):
-    r = None;
-    while (r == None or "Resource temporarily unavailable" in r.text):
-        if (r is not None): time.sleep(3)
-        r = requests.get("http://www.ncbi.nlm.nih.gov/sviewer/viewer.cgi?sendto=on&dopt=fasta&val=%s" % accession);
+    r = httpclient.get("http://www.ncbi.nlm.nih.gov/sviewer/viewer.cgi?sendto=on&dopt=fasta&val=%s" % accession,
+                       retryIf=lambda r: "Resource temporarily unavailable" in r.text);
     return r.text.strip();
 
 print(fetchContig(args.accession));
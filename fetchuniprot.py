@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-import requests
+import httpclient
 import urllib
 import re
 import time
@@ -44,7 +44,7 @@ parser.add_argument("-m","--match",default=None, help='Match only a specific typ
 args = parser.parse_args();
 
 swissprotUrl = "http://www.uniprot.org/uniprot/%s.xml" % args.accession
-r = requests.get(swissprotUrl);
+r = httpclient.get(swissprotUrl);
 
 ns = {'ns': 'http://uniprot.org/uniprot'};
 rootNode = ET.fromstring(r.text);
@@ -1,12 +1,14 @@
 #!/usr/bin/env python
 
 import requests
+import httpclient
 import urllib
 import re
 import time
 import sys
 import os.path
 import argparse
+import util
 from argparse import RawTextHelpFormatter
 
 help="""
@@ -22,11 +24,17 @@ Perform a blast using piped data
 
 Perform a blast and immediately return the first result info
     flybase.py blasn org/translation query.txt | viewblast.py into 1
+
+Results are cached in ~/.cache/blastresults (shared with blast.py), repeating a search returns at once.
+Use --refresh to search again, --cache-ttl and --cache-size to limit the cache
 """
 
 parser = argparse.ArgumentParser(description=help,formatter_class=RawTextHelpFormatter)
 parser.add_argument('program', help='program: blastn blastp blastx tblastn tblastx')
 parser.add_argument('database', help='database')
+parser.add_argument('--refresh', action='store_true', help='search again even when the result is cached (and cache the new result)')
+parser.add_argument('--cache-ttl', dest='cacheTtl', type=float, default=None, help='days a cached result stays valid (default: forever)')
+parser.add_argument('--cache-size', dest='cacheSize', type=float, default=None, help='megabytes the result cache may use (default: unlimited)')
 parser.add_argument('fasta', type=argparse.FileType('r'), nargs="?", default=sys.stdin, help='the FASTA sequence(s)')
 
 def extractBlastInfo(responseText):
@@ -80,15 +88,14 @@ def startBlast(program,database,query):
         'User-Agent':'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/45.0.2454.101 Safari/537.36'
     });
     prepared = req.prepare()
-    s = requests.Session()
-    r = s.send(prepared,allow_redirects=False);
+    r = httpclient.request(prepared.method,prepared.url,data=prepared.body,headers=prepared.headers,allow_redirects=False);
     url = r.headers["location"];
     return url;
 
 def waitForCompletion(jobUrl):
     i = 0;
     while(True):
-        r = requests.get(jobUrl);
+        r = httpclient.get(jobUrl);
         if ("text/xml" in r.headers["content-type"]):
             return r.text;
 
@@ -102,14 +109,24 @@ def main():
 
     fasta = args.fasta.read()
     sys.stderr.write("Program: %s\nDatabase: %s\nQuery: \n%s" % (args.program,args.database,fasta));
-    jobUrl = startBlast(args.program,args.database,fasta);
-    sys.stderr.write("JobURL: %s\n" % jobUrl);
-    time.sleep(5);
-    results = waitForCompletion(jobUrl);
+    cache = util.ResultCache(ttl=args.cacheTtl * 86400 if args.cacheTtl is not None else None,
+                             maxSize=int(args.cacheSize * 1024 * 1024) if args.cacheSize is not None else None);
+    #org and tax are fixed in startBlast
+    key = util.ResultCache.key("flybase",args.program,args.database,"dmel","drosophila",util.normalizeQuery(fasta));
+    results = None if args.refresh else cache.get(key);
+    jobUrl = None;
+    if (results is not None):
+        sys.stderr.write("Cached result\n");
+    else:
+        jobUrl = startBlast(args.program,args.database,fasta);
+        sys.stderr.write("JobURL: %s\n" % jobUrl);
+        time.sleep(5);
+        results = waitForCompletion(jobUrl);
+        if (util.isBlastXml(results)): cache.put(key,results);
 
     with open("_latest.blast","w") as f:
         f.write(results);
     print(results.strip());
-    sys.stderr.write("View in browser: %s\n" % jobUrl);
+    if (jobUrl): sys.stderr.write("View in browser: %s\n" % jobUrl);
 
 main();
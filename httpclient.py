@@ -0,0 +1,77 @@
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+#seconds to connect and to wait for data
+TIMEOUT = (10,120)
+#attempts after the first one
+RETRIES = 5
+#the n-th retry waits a random time of up to BACKOFF * 2^n seconds, never more than MAX_BACKOFF
+BACKOFF = 1
+MAX_BACKOFF = 60
+#responses worth trying again
+RETRY_STATUS = (429,500,502,503,504)
+#methods that can be sent twice without doing something twice
+IDEMPOTENT_METHODS = ("GET","HEAD","OPTIONS","PUT","DELETE")
+
+_local = threading.local()
+
+def session():
+    "The keep-alive session of this thread, connections to each host are pooled and reused between calls"
+    s = getattr(_local,"session",None);
+    if (s is None):
+        s = requests.Session();
+        adapter = HTTPAdapter(pool_connections=8,pool_maxsize=8);
+        s.mount("http://",adapter);
+        s.mount("https://",adapter);
+        s.headers["Accept-Encoding"] = "gzip, deflate";
+        _local.session = s;
+    return s;
+
+def backoff(attempt,response=None):
+    "Seconds to wait before retry number attempt (from 0), a Retry-After from the server wins when given"
+    retryAfter = response.headers.get("Retry-After") if response is not None else None;
+    if (retryAfter and retryAfter.isdigit()): return min(int(retryAfter),MAX_BACKOFF);
+    return random.uniform(0,min(BACKOFF * 2 ** attempt,MAX_BACKOFF));
+
+def notSent(error):
+    "Whether a request failed before the server could have received it (the connection was never made)"
+    if (isinstance(error,requests.exceptions.ConnectTimeout)): return True;
+    reason = getattr(error.args[0],"reason",None) if error.args else None;
+    return isinstance(reason,NewConnectionError);
+
+def request(method,url,retries=RETRIES,retryIf=None,idempotent=None,**kwargs):
+    """
+    Sends a request with the shared session, retrying up to retries times with exponential backoff and jitter:
+    connection errors, timeouts, RETRY_STATUS responses and responses for which retryIf(response) is true
+    A request that isn't idempotent (a POST, unless idempotent=True) is only sent again when the server can't have
+    acted on it: the connection failed or the response is 429 (or retryIf asks for it), never after a timeout or 5xx
+    Returns the last response, the error of the last attempt is raised when no response came
+    """
+    kwargs.setdefault("timeout",TIMEOUT);
+    if (idempotent is None): idempotent = method.upper() in IDEMPOTENT_METHODS;
+    retryStatus = RETRY_STATUS if idempotent else (429,);
+    attempt = 0;
+    while (True):
+        try:
+            r = session().request(method,url,**kwargs);
+        except (requests.ConnectionError,requests.Timeout) as e:
+            if (attempt >= retries or not (idempotent or notSent(e))): raise
+            time.sleep(backoff(attempt));
+            attempt += 1;
+            continue;
+        if (attempt >= retries or not (r.status_code in retryStatus or (retryIf is not None and retryIf(r)))):
+            return r;
+        #a streamed response holds its connection until closed
+        r.close();
+        time.sleep(backoff(attempt,r));
+        attempt += 1;
+
+def get(url,**kwargs):
+    return request("GET",url,**kwargs);
+
+def post(url,**kwargs):
+    return request("POST",url,**kwargs);
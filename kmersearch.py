@@ -0,0 +1,552 @@
+#!/usr/bin/env python
+
+import sys
+import os
+import json
+import math
+import mmap
+import array
+import bisect
+import hashlib
+import heapq
+import argparse
+import collections
+import translate
+import extractfastaseq
+from xml.sax.saxutils import escape
+from argparse import RawTextHelpFormatter
+
+#numpy is needed to build the index, searching an index that is already built works without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+help="""
+Quickly finds the contigs of a local fasta database (eg: a Trinity assembly) that resemble the query sequences
+
+The database is searched through an index of its k-mers: nucleotide k-mers of the contigs and amino acid k-mers
+of their six frame translation. Contigs are ranked by the number of k-mers they share with the query, counting
+only the shared k-mers (seeds) that lie on nearly the same diagonal. There is no alignment, the result is a
+prefilter that narrows a large database to a handful of contigs worth a real blast.
+
+The output is blast XML (like -outfmt 5) with one result per contig, so viewblast.py reads it as it is
+    kmersearch.py Trinity.fasta opsin.fasta | viewblast.py list -n 5
+
+The program is picked from the query: nucleotide queries are searched like blastn (both strands), protein
+queries like tblastn. Translated nucleotide queries (all six frames) against the translated database:
+    kmersearch.py Trinity.fasta query.fasta -p tblastx > out.blast
+
+Every query of a multi-fasta file is searched, each is a separate query of the result
+    kmersearch.py Trinity.fasta queries.fasta | viewblast.py list --per-query 3 -f '{Iteration_query-def}\\t{Hit_accession}\\t{e}'
+
+The contigs found are in the database, extract them with extractfastaseq.py instead of viewblast.py contig
+    kmersearch.py Trinity.fasta opsin.fasta | viewblast.py info 1 -f '{Hit_accession}' | extractfastaseq.py Trinity.fasta
+
+The first search of a database builds the index next to it (Trinity.fasta.kmi, or in ~/.cache/kmersearch when
+that location is read only). It is rebuilt automatically when the database changes or the k-mer sizes differ.
+Only plain (uncompressed) fasta databases can be indexed, and building the index needs numpy. The k-mers are
+sorted a few million at a time into temporary files next to the index and merged, so indexing a large assembly
+needs disk space rather than memory: the index is about 20 times the size of the database, and as much again while
+it is built.
+
+Each result has a single HSP covering the seeds of its best diagonal, without gaps:
+    Hsp_score is the number of seeds on that diagonal and the evalue an estimate of how often that many seeds
+    would be found by chance, Hsp_bit-score is -log2 of that chance (for a single diagonal). Hit_num ranks the contigs by seeds on the
+    best diagonal, then by all seeds shared with the query.
+"""
+
+def kmerSize(largest):
+    "argparse type for k-mer sizes from 1 to largest, larger k-mers don't fit the 64 bit k-mer values of the index"
+    def parse(text):
+        try:
+            k = int(text);
+        except ValueError:
+            raise argparse.ArgumentTypeError("not a number: %s" % text);
+        if (not 1 <= k <= largest): raise argparse.ArgumentTypeError("k-mer size must be between 1 and %d: %s" % (largest,text));
+        return k;
+    return parse;
+
+parser = argparse.ArgumentParser(description=help,formatter_class=RawTextHelpFormatter)
+parser.add_argument('database', help='the fasta database to search')
+parser.add_argument('query', type=argparse.FileType('r'), nargs="?", default=sys.stdin, help='the query sequences (fasta, default: stdin)')
+parser.add_argument('-p', '--program', choices=["auto","blastn","tblastn","tblastx"], default="auto", help='blastn: nucleotide query, tblastn: protein query, tblastx: translated nucleotide query (default: blastn or tblastn from the query)')
+#4^32 and 20^14 are the largest k-mer value ranges that fit 64 bits
+parser.add_argument('-k', dest="k", type=kmerSize(32), default=11, help='nucleotide k-mer size, at most 32 (default 11)')
+parser.add_argument('--proteink', dest="proteinK", type=kmerSize(14), default=5, help='amino acid k-mer size, at most 14 (default 5)')
+parser.add_argument('-n', '--max', type=int, default=50, help='maximum number of contigs reported per query (default 50)')
+parser.add_argument('-s', '--minseeds', type=int, default=2, help='minimum number of seeds on the best diagonal of a contig (default 2)')
+parser.add_argument('-e', '--evalue', type=float, default=10, help='only report contigs with at most this evalue (default 10)')
+parser.add_argument('--maxfreq', type=int, default=1000, help='ignore k-mers found more than this many times in the database (repeats, default 1000)')
+
+NUCLEOTIDES = "ACGT"
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+def codeTable(letters,extra={}):
+    "A bytes.translate() table mapping each letter (either case) to its index, anything else to len(letters)"
+    table = bytearray([len(letters)] * 256);
+    for code,letter in enumerate(letters):
+        table[ord(letter)] = table[ord(letter.lower())] = code;
+    for letter,code in extra.items():
+        table[ord(letter)] = table[ord(letter.lower())] = code;
+    return bytes(table);
+
+NUCLEOTIDE_CODES = codeTable(NUCLEOTIDES,{"U":3})
+AMINO_ACID_CODES = codeTable(AMINO_ACIDS)
+
+#the index holds a section of k-mers per alphabet: (letter codes, alphabet size)
+SECTIONS = {"nucleotide":(NUCLEOTIDE_CODES,len(NUCLEOTIDES)), "protein":(AMINO_ACID_CODES,len(AMINO_ACIDS))}
+#numpy types of the array codes of the index
+ARRAY_DTYPES = {"Q":"uint64", "I":"uint32", "H":"uint16", "b":"int8"}
+INDEX_SUFFIX = ".kmi"
+INDEX_FORMAT = "kmersearch"
+INDEX_VERSION = 2
+#postings sorted in memory at once while indexing, each sorted run is written to a temporary file
+RUN_SIZE = 4 * 1024 * 1024
+#postings taken from all runs at once while merging them
+MERGE_SIZE = 4 * 1024 * 1024
+INDEX_CACHE_DIR = os.path.join(os.path.expanduser("~"),".cache","kmersearch")
+#seeds whose diagonals differ by less than this are on the same diagonal, allowing for small indels
+DIAGONAL_WIDTH = 8
+
+def kmers(sequence,k,codes,base):
+    """
+    Returns the start positions and values of the k-mers of sequence (bytes), skipping k-mers with letters that are
+    not in the alphabet. A k-mer's value is its letter codes read as a number in base base
+    """
+    encoded = sequence.translate(codes);
+    count = len(encoded) - k + 1;
+    if (numpy is not None):
+        if (count <= 0): return numpy.zeros(0,dtype=numpy.intp),numpy.zeros(0,dtype=numpy.uint64);
+        letters = numpy.frombuffer(encoded,dtype=numpy.uint8);
+        invalid = numpy.concatenate(([0],numpy.cumsum(letters >= base)));
+        values = numpy.zeros(count,dtype=numpy.uint64);
+        for i in range(k):
+            values = values * numpy.uint64(base) + letters[i:i+count].astype(numpy.uint64);
+        keep = invalid[k:] == invalid[:count];
+        return numpy.nonzero(keep)[0],values[keep];
+
+    positions = array.array("I");
+    values = array.array("Q");
+    top = base ** k;
+    value = 0;
+    valid = 0;
+    for pos,code in enumerate(encoded):
+        if (code >= base):
+            valid = 0;
+            value = 0;
+            continue;
+        value = (value * base + code) % top;
+        valid += 1;
+        if (valid >= k):
+            positions.append(pos - k + 1);
+            values.append(value);
+    return positions,values;
+
+def reverseComplement(sequence):
+    return sequence.translate(str.maketrans("ACGTUN","TGCAAN"))[::-1];
+
+def translatedFrames(sequence):
+    "The six frame translation of a nucleotide sequence as (frame,amino acids), reverse frames count from the 3' end"
+    return [(int(name),aa) for name,aa in translate.translateFrames(translate.dnaToRna(sequence.upper()),True)];
+
+def sectionArrays(name,k,contigs,longest):
+    """
+    The array codes of a section, each as narrow as it can be: the k-mer values, then the contig number and the
+    position (and frame for protein) of each. longest is the length of the longest sequence k-mers are taken from
+    """
+    codes,base = SECTIONS[name];
+    arrays = ["I" if base ** k <= 2 ** 32 else "Q","H" if contigs <= 2 ** 16 else "I","H" if longest <= 2 ** 16 else "I"];
+    if (name == "protein"): arrays.append("b");
+    return arrays;
+
+class SortedRuns:
+    """
+    The postings of a section (k-mer value, contig, position and frame) collected RUN_SIZE at a time, each batch
+    sorted on the k-mer values and appended to a temporary file of sorted runs, which merge() writes out as one
+    """
+    def __init__(self,path,arrays):
+        self.path = path;
+        self.file = open(path,"w+b");
+        self.dtypes = [numpy.dtype(ARRAY_DTYPES[code]) for code in arrays];
+        self.pending = [];
+        self.size = 0;
+        self.runs = [];
+        self.count = 0;
+
+    def add(self,*columns):
+        "Adds postings as one array (or a single value for all) per array of the section"
+        count = len(columns[0]);
+        if (count == 0): return;
+        self.pending.append([numpy.asarray(column).astype(dtype) if hasattr(column,"__len__") else numpy.full(count,column,dtype=dtype)
+                             for column,dtype in zip(columns,self.dtypes)]);
+        self.size += count;
+        if (self.size >= RUN_SIZE): self.flush();
+
+    def flush(self):
+        if (not self.size): return;
+        columns = [numpy.concatenate([p[i] for p in self.pending]) for i in range(len(self.dtypes))];
+        order = numpy.argsort(columns[0],kind="stable");
+        self.runs.append((self.file.tell(),self.size));
+        for column in columns:
+            self.file.write(column[order].tobytes());
+        self.count += self.size;
+        self.pending = [];
+        self.size = 0;
+
+    def merge(self,out):
+        """
+        Writes the merged runs to out at its position as the arrays of the section, each starting on an 8 byte
+        boundary. A block of each run is merged at a time, up to the smallest last value of the blocks
+        """
+        self.flush();
+        self.file.flush();
+        start = out.tell();
+        offsets = [];
+        for dtype in self.dtypes:
+            offsets.append(start);
+            start += self.count * dtype.itemsize + padding(self.count * dtype.itemsize);
+        if (self.count):
+            data = numpy.memmap(self.file,dtype=numpy.uint8,mode="r");
+            runs = [];
+            for offset,count in self.runs:
+                columns = [];
+                for dtype in self.dtypes:
+                    columns.append(numpy.frombuffer(data,dtype=dtype,count=count,offset=offset));
+                    offset += count * dtype.itemsize;
+                runs.append(columns);
+            block = max(1024,MERGE_SIZE // len(runs));
+            cursors = [0] * len(runs);
+            written = 0;
+            while (written < self.count):
+                live = [i for i in range(len(runs)) if cursors[i] < len(runs[i][0])];
+                bound = min([runs[i][0][min(cursors[i] + block,len(runs[i][0])) - 1] for i in live]);
+                pieces = [];
+                for i in live:
+                    end = cursors[i] + int(numpy.searchsorted(runs[i][0][cursors[i]:cursors[i] + block],bound,side="right"));
+                    pieces.append([column[cursors[i]:end] for column in runs[i]]);
+                    cursors[i] = end;
+                columns = [numpy.concatenate([piece[j] for piece in pieces]) for j in range(len(self.dtypes))];
+                order = numpy.argsort(columns[0],kind="stable");
+                for column,offset,dtype in zip(columns,offsets,self.dtypes):
+                    out.seek(offset + written * dtype.itemsize);
+                    out.write(column[order].tobytes());
+                written += len(order);
+            del runs,data;
+        out.seek(start);
+        out.truncate();
+
+    def close(self):
+        self.file.close();
+        os.remove(self.path);
+
+def buildKmerIndex(path,database,entries,k,proteinK,header):
+    """
+    Writes the k-mer index of database to path: the nucleotide and translated k-mers of every contig are sorted
+    into runs in temporary files next to path, which are then merged into the sections of the index
+    """
+    longest = max([entry.length for entry in entries],default=0);
+    arrays = {"nucleotide":sectionArrays("nucleotide",k,len(entries),longest),
+              "protein":sectionArrays("protein",proteinK,len(entries),longest // 3 + 1)};
+    tmp = "%s.%d.tmp" % (path,os.getpid());
+    runs = {};
+    try:
+        for name in SECTIONS:
+            runs[name] = SortedRuns("%s.%s" % (tmp,name),arrays[name]);
+        with extractfastaseq.MappedFasta(database) as mapped:
+            for number,entry in enumerate(entries):
+                sequence = mapped.sequence(extractfastaseq.entryRecord(entry)).upper();
+                positions,values = kmers(sequence,k,NUCLEOTIDE_CODES,len(NUCLEOTIDES));
+                runs["nucleotide"].add(values,number,positions);
+                for frame,aa in translatedFrames(sequence.decode("latin-1")):
+                    positions,values = kmers(aa.encode("latin-1"),proteinK,AMINO_ACID_CODES,len(AMINO_ACIDS));
+                    runs["protein"].add(values,number,positions,frame);
+        header = dict(header,arrays=arrays,sections={name:runs[name].count + runs[name].size for name in SECTIONS});
+        with open(tmp,"wb") as f:
+            line = (json.dumps(header) + "\n").encode("utf-8");
+            f.write(line + b"\0" * padding(len(line)));
+            for name in SECTIONS:
+                runs[name].merge(f);
+        os.replace(tmp,path);
+    finally:
+        for sortedRuns in runs.values():
+            sortedRuns.close();
+        if (os.path.exists(tmp)): os.remove(tmp);
+
+def padding(size):
+    return (-size) % 8;
+
+class KmerIndex:
+    """
+    The k-mer index of a database read through mmap: a JSON header line then, for each section, the sorted k-mer
+    values followed by the contig, position and frame of each (their array codes are in the header's arrays), every
+    array starting on an 8 byte boundary
+    Looking up a k-mer is a binary search of the values, nothing is loaded up front
+    """
+    def __init__(self,path):
+        self.file = open(path,"rb");
+        self.map = mmap.mmap(self.file.fileno(),0,access=mmap.ACCESS_READ);
+        headerEnd = self.map.find(b"\n") + 1;
+        self.header = json.loads(self.map[:headerEnd].decode("utf-8"));
+        self.sections = {};
+        offset = headerEnd + padding(headerEnd);
+        view = memoryview(self.map);
+        for name in SECTIONS:
+            count = self.header["sections"][name];
+            columns = [];
+            for code in self.header["arrays"][name]:
+                size = count * array.array(code).itemsize;
+                columns.append(view[offset:offset+size].cast(code));
+                offset += size + padding(size);
+            self.sections[name] = columns;
+
+    def matches(self,database,signature,k,proteinK):
+        return (self.header.get("format") == INDEX_FORMAT and self.header.get("version") == INDEX_VERSION
+                and self.header.get("database") == os.path.abspath(database) and self.header.get("signature") == signature
+                and self.header.get("k") == k and self.header.get("proteinK") == proteinK);
+
+    def postings(self,section,value):
+        "The range of postings of the k-mer value in the arrays of section"
+        values = self.sections[section][0];
+        lo = bisect.bisect_left(values,value);
+        return lo,bisect.bisect_right(values,value,lo);
+
+    def close(self):
+        for columns in self.sections.values():
+            for column in columns: column.release();
+        self.sections = {};
+        self.map.close();
+        self.file.close();
+
+def kmerIndexPaths(database):
+    "Where the index of database may be: next to it, or in the cache directory when that is read only"
+    name = hashlib.sha1(os.path.abspath(database).encode("utf-8")).hexdigest() + INDEX_SUFFIX;
+    return [database + INDEX_SUFFIX,os.path.join(INDEX_CACHE_DIR,name)];
+
+def getKmerIndex(database,entries,k,proteinK):
+    "Opens the k-mer index of database, building (and saving) a new one if it is missing or stale"
+    signature = extractfastaseq.fileSignature(database);
+    paths = kmerIndexPaths(database);
+    for path in paths:
+        try:
+            index = KmerIndex(path);
+        except (OSError,ValueError,KeyError):
+            continue;
+        if (index.matches(database,signature,k,proteinK)): return index;
+        index.close();
+
+    if (numpy is None):
+        sys.stderr.write("numpy is needed to index %s (pip install numpy)\n" % database);
+        sys.exit(1);
+    sys.stderr.write("Indexing %s\n" % database);
+    header = {"format":INDEX_FORMAT, "version":INDEX_VERSION, "database":os.path.abspath(database), "signature":signature,
+              "k":k, "proteinK":proteinK, "contigs":len(entries), "letters":sum([entry.length for entry in entries])};
+    for path in paths:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True);
+            buildKmerIndex(path,database,entries,k,proteinK,header);
+            return KmerIndex(path);
+        except OSError:
+            continue;
+    raise OSError("Can't write the k-mer index of %s" % database);
+
+def isNucleotide(sequence):
+    "At least 90% of the residues are nucleotides (N for unknown)"
+    return sum([sequence.count(c) for c in "ACGTUN"]) >= 0.9 * len(sequence) if sequence else True;
+
+def queryLanes(sequence,program):
+    "The strands or frames of the query that are searched, as (frame,residues)"
+    if (program == "blastn"): return [(1,sequence),(-1,reverseComplement(sequence))];
+    if (program == "tblastx"): return translatedFrames(sequence);
+    return [(0,sequence)];
+
+def bestDiagonal(seeds):
+    "The seeds of a list of (diagonal,query position) that fit in the window of diagonals holding the most of them"
+    seeds.sort();
+    best = (0,0);
+    start = 0;
+    for end in range(len(seeds)):
+        while (seeds[end][0] - seeds[start][0] >= DIAGONAL_WIDTH): start += 1;
+        if (end + 1 - start > best[1] - best[0]): best = (start,end + 1);
+    return seeds[best[0]:best[1]];
+
+def seedRuns(seeds,k):
+    """
+    Returns the number of runs of overlapping seeds on the same diagonal and the number of letters they cover
+    A match of k+1 letters is 2 seeds but a single chance event
+    """
+    runs = 0;
+    covered = 0;
+    last = None;
+    for diagonal,queryPos in sorted(seeds):
+        if (last is None or diagonal != last[0] or queryPos - last[1] >= k):
+            runs += 1;
+            covered += k;
+        else:
+            covered += queryPos - last[1];
+        last = (diagonal,queryPos);
+    return runs,covered;
+
+def logChance(runs,covered,k,expected,base):
+    """
+    The natural log of the chance of finding runs seed runs covering covered letters where expected seeds are
+    expected by chance: the leading term of the Poisson tail, and each letter a run extends past its first seed
+    matching with a chance of 1/base
+    """
+    if (expected <= 0): return -math.inf;
+    return min(0.0,runs * math.log(expected) - expected - math.lgamma(runs + 1) - (covered - runs * k) * math.log(base));
+
+Seed = collections.namedtuple("Seed",["contig","seeds","total","queryFrame","hitFrame","diagonal","start","end","logChance","evalue"])
+
+def searchQuery(index,sequence,program,args):
+    """
+    Counts the seeds the query shares with each contig, grouped by query and hit frame, and returns the best
+    args.max contigs as Seeds, ranked by seeds on the best diagonal and then by all seeds of the contig
+    """
+    section = "nucleotide" if program == "blastn" else "protein";
+    codes,base = SECTIONS[section];
+    k = index.header["k"] if section == "nucleotide" else index.header["proteinK"];
+    contigs,positions = index.sections[section][1:3];
+    frames = index.sections[section][3] if section == "protein" else None;
+
+    found = collections.defaultdict(lambda: collections.defaultdict(list));
+    queryKmers = 0;
+    for queryFrame,residues in queryLanes(sequence,program):
+        queryPositions,values = kmers(residues.encode("latin-1"),k,codes,base);
+        queryKmers = max(queryKmers,len(queryPositions));
+        for queryPos,value in zip(list(queryPositions),list(values)):
+            lo,hi = index.postings(section,value);
+            if (hi - lo > args.maxfreq): continue;
+            for i in range(lo,hi):
+                hitFrame = frames[i] if frames is not None else queryFrame;
+                found[contigs[i]][(queryFrame,hitFrame)].append((positions[i] - queryPos,queryPos));
+
+    #seeds expected on a window of diagonals by chance, and the number of windows searched
+    letters = index.header["letters"] / (3 if section == "protein" else 1);
+    expected = DIAGONAL_WIDTH * queryKmers / float(base ** k);
+    windows = max(1.0,(letters + index.header["contigs"] * queryKmers) / DIAGONAL_WIDTH) * (6 if section == "protein" else 2);
+    candidates = [];
+    for contig,groups in found.items():
+        total = sum([len(seeds) for seeds in groups.values()]);
+        if (total < args.minseeds): continue;
+        seeds,(queryFrame,hitFrame) = max([(bestDiagonal(seeds),lane) for lane,seeds in groups.items()],key=lambda best: len(best[0]));
+        if (len(seeds) < args.minseeds): continue;
+        chance = logChance(*seedRuns(seeds,k),k,expected,base);
+        evalue = math.exp(chance) * windows;
+        if (evalue > args.evalue): continue;
+        starts = [queryPos for diagonal,queryPos in seeds];
+        candidates.append(Seed(contig,len(seeds),total,queryFrame,hitFrame,seeds[len(seeds) // 2][0],min(starts),max(starts) + k,chance,evalue));
+    return heapq.nlargest(args.max,candidates,key=lambda seed: (seed.seeds,seed.total,-seed.contig));
+
+def frameRange(frame,start,end,sequence,step):
+    """
+    1 based from,to on a nucleotide sequence of the residues [start,end) of one of its translatedFrames(), from > to
+    on the reverse strand. The reverse frames translate only the bases (N.. are dropped), so positions are mapped back
+    through the bases that were kept, as in translate.findOrfs
+    """
+    if (frame == 0): return start + 1,end;
+    first = abs(frame) - 1 + step * start;
+    last = abs(frame) - 1 + step * end;
+    if (frame > 0): return first + 1,min(last,len(sequence));
+    kept = [i for i,c in enumerate(sequence) if c in "ACGTU"][::-1];
+    return kept[first] + 1,kept[min(last,len(kept)) - 1] + 1;
+
+def hitHsp(mapped,entry,query,lanes,seed,program):
+    "The Hsp_* fields of the ungapped alignment of the seeds of the best diagonal of a contig"
+    sequence = mapped.sequence(extractfastaseq.entryRecord(entry)).decode("latin-1").upper();
+    if (program == "blastn"):
+        target = sequence;
+    else:
+        target = dict(translatedFrames(sequence))[seed.hitFrame];
+    residues = lanes[seed.queryFrame];
+    queryStart,queryEnd = seed.start,seed.end;
+    hitStart,hitEnd = queryStart + seed.diagonal,queryEnd + seed.diagonal;
+    if (hitStart < 0):
+        queryStart -= hitStart;
+        hitStart = 0;
+    if (hitEnd > len(target)):
+        queryEnd -= hitEnd - len(target);
+        hitEnd = len(target);
+    qseq = residues[queryStart:queryEnd];
+    hseq = target[hitStart:hitEnd];
+
+    if (program == "blastn"):
+        queryFrom,queryTo = queryStart + 1,queryEnd;
+        hitFrom,hitTo = hitStart + 1,hitEnd;
+        queryFrame,hitFrame = 1,seed.hitFrame;
+        if (seed.queryFrame < 0):
+            #like blast: the query forward, the hit on its reverse strand. reverseComplement() keeps every letter
+            queryFrom,queryTo = len(query) - queryEnd + 1,len(query) - queryStart;
+            hitFrom,hitTo = hitTo,hitFrom;
+            qseq,hseq = reverseComplement(qseq),reverseComplement(hseq);
+    else:
+        queryFrom,queryTo = frameRange(seed.queryFrame,queryStart,queryEnd,query,3);
+        hitFrom,hitTo = frameRange(seed.hitFrame,hitStart,hitEnd,sequence,3);
+        queryFrame,hitFrame = seed.queryFrame,seed.hitFrame;
+    identical = [a == b for a,b in zip(qseq,hseq)];
+    midline = "".join([("|" if program == "blastn" else a) if same else " " for a,same in zip(qseq,identical)]);
+    return [("Hsp_num",1),("Hsp_bit-score","%.1f" % (-seed.logChance / math.log(2))),
+            ("Hsp_score",seed.seeds),("Hsp_evalue","%.3g" % seed.evalue),
+            ("Hsp_query-from",queryFrom),("Hsp_query-to",queryTo),("Hsp_hit-from",hitFrom),("Hsp_hit-to",hitTo),
+            ("Hsp_query-frame",queryFrame),("Hsp_hit-frame",hitFrame),("Hsp_identity",sum(identical)),
+            ("Hsp_positive",sum(identical)),("Hsp_gaps",0),("Hsp_align-len",len(qseq)),
+            ("Hsp_qseq",qseq),("Hsp_hseq",hseq),("Hsp_midline",midline)];
+
+def xmlFields(fields,indent):
+    return "".join(["%s<%s>%s</%s>\n" % (indent,name,escape(str(value)),name) for name,value in fields]);
+
+def writeHeader(out,program,database,query):
+    out.write('<?xml version="1.0"?>\n<!DOCTYPE BlastOutput PUBLIC "-//NCBI//NCBI BlastOutput/EN" "http://www.ncbi.nlm.nih.gov/dtd/NCBI_BlastOutput.dtd">\n<BlastOutput>\n');
+    out.write(xmlFields([("BlastOutput_program",program),("BlastOutput_version","kmersearch"),("BlastOutput_db",database),
+                         ("BlastOutput_query-ID",query[0]),("BlastOutput_query-def",query[1]),("BlastOutput_query-len",query[2])],"  "));
+    out.write("  <BlastOutput_iterations>\n");
+
+def writeIteration(out,number,query,hits):
+    "Writes the result of a query, hits are (Hit_* fields,Hsp_* fields) in order"
+    out.write("    <Iteration>\n");
+    out.write(xmlFields([("Iteration_iter-num",number),("Iteration_query-ID",query[0]),("Iteration_query-def",query[1]),("Iteration_query-len",query[2])],"      "));
+    out.write("      <Iteration_hits>\n");
+    for hit,hsp in hits:
+        out.write("        <Hit>\n" + xmlFields(hit,"          ") + "          <Hit_hsps>\n            <Hsp>\n");
+        out.write(xmlFields(hsp,"              ") + "            </Hsp>\n          </Hit_hsps>\n        </Hit>\n");
+    out.write("      </Iteration_hits>\n");
+    if (not hits): out.write("      <Iteration_message>No hits found</Iteration_message>\n");
+    out.write("    </Iteration>\n");
+    out.flush();
+
+def writeFooter(out):
+    out.write("  </BlastOutput_iterations>\n</BlastOutput>\n");
+
+def main():
+    args = parser.parse_args();
+    if (extractfastaseq.gzipKind(args.database) is not None):
+        sys.stderr.write("%s is compressed, only plain fasta databases can be indexed\n" % args.database);
+        sys.exit(1);
+    entries = extractfastaseq.getIndex(args.database);
+    index = getKmerIndex(args.database,entries,args.k,args.proteinK);
+    out = sys.stdout;
+    started = False;
+    with extractfastaseq.MappedFasta(args.database) as mapped:
+        for number,(header,sequence) in enumerate(translate.readRecords(args.query),1):
+            sequence = "".join(sequence.split()).upper();
+            program = args.program;
+            if (program == "auto"): program = "blastn" if isNucleotide(sequence) else "tblastn";
+            query = ("Query_%d" % number,(header or ">")[1:].strip() or "No definition line",len(sequence));
+            if (not started):
+                writeHeader(out,program,args.database,query);
+                started = True;
+            lanes = dict(queryLanes(sequence,program));
+            hits = [];
+            for rank,seed in enumerate(searchQuery(index,sequence,program,args),1):
+                entry = entries[seed.contig];
+                definition = entry.header[1:].split(None,1);
+                hit = [("Hit_num",rank),("Hit_id",entry.id),("Hit_def",definition[1] if len(definition) > 1 else entry.id),
+                       ("Hit_accession",entry.id),("Hit_len",entry.length)];
+                hits.append((hit,hitHsp(mapped,entry,sequence,lanes,seed,program)));
+            writeIteration(out,number,query,hits);
+    if (not started): writeHeader(out,"blastn" if args.program == "auto" else args.program,args.database,("Query_1","No definition line",0));
+    writeFooter(out);
+    index.close();
+
+if __name__ == "__main__":
+    main()
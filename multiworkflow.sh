@@ -23,11 +23,7 @@ do
 
 	#Get the first result from the blast
 	#viewblast.py list 2_TBLASTN_RESULT.blast -f '{Hit_id}'
-	viewblast.py list 2_TBLASTN_RESULT.blast -f '{Hit_id}' | head -n 20 | nl | while read line; do
-		RESULT_NUM=`echo $line | awk -F' ' '{print $1}'`
-		RESULT_EVALUE=`viewblast.py info $RESULT_NUM 2_TBLASTN_RESULT.blast -f '{e}'`
-		RESULT_IDENTIFIER=`viewblast.py info $RESULT_NUM 2_TBLASTN_RESULT.blast -f '{Hit_id}'`
-		RESULT_CONTIG=`cat 2_TBLASTN_RESULT.blast | viewblast.py info $RESULT_NUM -f '{Hit_def}'`
+	viewblast.py info 1-20 2_TBLASTN_RESULT.blast --fields e,Hit_id,Hit_def | while IFS=$'\t' read -r RESULT_NUM RESULT_EVALUE RESULT_IDENTIFIER RESULT_CONTIG; do
 
 		mkdir "RESULT_$RESULT_NUM"
 		cd "RESULT_$RESULT_NUM"
@@ -41,9 +37,11 @@ do
 		>&2 echo "Running flybase blast: $RESULT_NUM $RESULT_IDENTIFIER"
 		flybase.py blastp org/translation 3_TRANSLATED_RESULT.fasta > 4_FLYBASE_RESULT.blast 2> /dev/null
 
-		FLYBASE_EVALUE1=`viewblast.py info 1 4_FLYBASE_RESULT.blast -f '{e}'`
-		FLYBASE_ACCESSION1=`viewblast.py info 1 4_FLYBASE_RESULT.blast -f '{Hit_accession}'`
-		FLYBASE_NCBI1=`viewblast.py info 1 4_FLYBASE_RESULT.blast -f '{Hit_def}' | perl -nle 'print "$1" if (/GB_protein:(.*?)[,; ]/)'`
+		FLYBASE_ROWS=`viewblast.py info 1-2 4_FLYBASE_RESULT.blast --fields e,Hit_accession,Hit_def`
+		IFS=$'\t' read -r _ FLYBASE_EVALUE1 FLYBASE_ACCESSION1 FLYBASE_DEF1 <<< "`echo "$FLYBASE_ROWS" | sed -n 1p`"
+		IFS=$'\t' read -r _ FLYBASE_EVALUE2 FLYBASE_ACCESSION2 FLYBASE_DEF2 <<< "`echo "$FLYBASE_ROWS" | sed -n 2p`"
+
+		FLYBASE_NCBI1=`echo "$FLYBASE_DEF1" | perl -nle 'print "$1" if (/GB_protein:(.*?)[,; ]/)'`
 
 		FLYBASE_HEADER1=""
 		if [[ ! -z  $FLYBASE_NCBI1  ]]
@@ -51,9 +49,7 @@ do
 			FLYBASE_HEADER1=`fetchaccession.py $FLYBASE_NCBI1 | head -n 1`
 		fi
 
-		FLYBASE_EVALUE2=`viewblast.py info 2 4_FLYBASE_RESULT.blast -f '{e}'`
-		FLYBASE_ACCESSION2=`viewblast.py info 2 4_FLYBASE_RESULT.blast -f '{Hit_accession}'`
-		FLYBASE_NCBI2=`viewblast.py info 2 4_FLYBASE_RESULT.blast -f '{Hit_def}' | perl -nle 'print "$1" if (/GB_protein:(.*?)[,; ]/)'`
+		FLYBASE_NCBI2=`echo "$FLYBASE_DEF2" | perl -nle 'print "$1" if (/GB_protein:(.*?)[,; ]/)'`
 
 		FLYBASE_HEADER2=""
 		if [[ ! -z  $FLYBASE_NCBI2  ]]
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#tests of blast.py batch mode against a local stand-in of Blast.cgi, run with: python3 -m unittest test_blast
+
+import io
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import collections
+import http.server
+import urllib.parse
+from unittest import mock
+import util
+import blast
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    """
+    Answers the Blast.cgi requests of blast.py: Put starts a search (a query containing BAD gets no RID),
+    SearchInfo says READY and the XML result takes DOWNLOAD_TIME seconds to send
+    """
+    protocol_version = "HTTP/1.1"
+    DOWNLOAD_TIME = 0.3
+
+    def log_message(self,*args):
+        pass
+
+    def reply(self,body):
+        body = body.encode();
+        self.send_response(200);
+        self.send_header("Content-Length",str(len(body)));
+        self.end_headers();
+        self.wfile.write(body);
+
+    def handle_any(self):
+        server = self.server;
+        length = int(self.headers.get("Content-Length") or 0);
+        if (length): self.rfile.read(length);
+        params = {name: values[0] for name,values in urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query).items()};
+        with server.lock:
+            server.starts.append(time.monotonic());
+            server.requests[params.get("FORMAT_OBJECT") or params.get("FORMAT_TYPE") or params["CMD"]] += 1;
+        if (params["CMD"] == "Put"):
+            query = urllib.parse.unquote(params["QUERY"]);
+            if ("BAD" in query): return self.reply("<html>Error: no search</html>");
+            with server.lock:
+                rid = "RID%d" % len(server.queries);
+                server.queries[rid] = query;
+            return self.reply("<!--QBlastInfoBegin\n    RID = %s\n    RTOE = 0\nQBlastInfoEnd\n-->" % rid);
+        if (params.get("FORMAT_OBJECT") == "SearchInfo"):
+            return self.reply("<!--QBlastInfoBegin\n    Status=READY\nQBlastInfoEnd\n-->");
+        with server.lock:
+            server.downloads += 1;
+            server.mostDownloads = max(server.mostDownloads,server.downloads);
+        time.sleep(self.DOWNLOAD_TIME);
+        with server.lock:
+            server.downloads -= 1;
+        definition = server.queries[params["RID"]].split("\n")[0][1:];
+        self.reply("<?xml version=\"1.0\"?>\n<BlastOutput>\n  <BlastOutput_iterations>\n    <Iteration>\n"
+                   "      <Iteration_query-def>%s</Iteration_query-def>\n    </Iteration>\n  </BlastOutput_iterations>\n</BlastOutput>\n" % definition);
+
+    do_GET = handle_any
+    do_POST = handle_any
+
+#seconds between the requests of a test batch
+INTERVAL = 0.1
+
+class BatchTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1",0),StandIn);
+        cls.server.daemon_threads = True;
+        cls.server.lock = threading.Lock();
+        cls.thread = threading.Thread(target=cls.server.serve_forever,daemon=True);
+        cls.thread.start();
+        cls.url = "http://127.0.0.1:%d/Blast.cgi" % cls.server.server_address[1];
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown();
+        cls.server.server_close();
+
+    def setUp(self):
+        self.server.requests = collections.Counter();
+        self.server.starts = [];
+        self.server.queries = {};
+        self.server.downloads = 0;
+        self.server.mostDownloads = 0;
+        self.directory = tempfile.mkdtemp();
+        self.addCleanup(shutil.rmtree,self.directory);
+        #results are cached in the test's own directory
+        patcher = mock.patch.object(blast,"resultCache",return_value=util.ResultCache(os.path.join(self.directory,"cache")));
+        patcher.start();
+        self.addCleanup(patcher.stop);
+
+    def runBatch(self,names,*options):
+        "Runs blast.py --batch on a FASTA of a record per name, returns the exit status"
+        fasta = os.path.join(self.directory,"queries.fasta");
+        with open(fasta,"w") as f:
+            for name in names:
+                f.write(">%s\nMNGTEGPNFYVPFSNKTGVV\n" % name);
+        argv = ["blast.py","tblastn","tsa_nt",fasta,"--batch",os.path.join(self.directory,"out"),"--url",self.url,"--interval",str(INTERVAL)];
+        with mock.patch.object(sys,"argv",argv + list(options)), mock.patch.object(sys,"stderr",io.StringIO()):
+            with self.assertRaises(SystemExit) as exit:
+                blast.main();
+        return exit.exception.code;
+
+    def outputs(self):
+        return sorted(os.listdir(os.path.join(self.directory,"out")));
+
+    def test_searches_run_concurrently(self):
+        started = time.monotonic();
+        self.assertEqual(self.runBatch(["a","b","c","d"],"-c","3"),0);
+        self.assertEqual(self.outputs(),["1.blast","2.blast","3.blast","4.blast"]);
+        #a download doesn't hold up the requests of the other searches
+        self.assertGreaterEqual(self.server.mostDownloads,2);
+        #requests are started INTERVAL apart, they arrive with some jitter but never sooner
+        self.assertEqual(len(self.server.starts),12);
+        self.assertGreaterEqual(self.server.starts[-1] - started,11 * INTERVAL);
+
+    def test_failed_search_fails_alone(self):
+        self.assertEqual(self.runBatch(["a","BAD","c"]),1);
+        self.assertEqual(self.outputs(),["1.blast","3.blast"]);
+        with open(os.path.join(self.directory,"out","3.blast")) as f:
+            self.assertIn("<Iteration_query-def>c</Iteration_query-def>",f.read());
+
+    def test_rerun_is_served_from_the_cache(self):
+        self.assertEqual(self.runBatch(["a","b"]),0);
+        shutil.rmtree(os.path.join(self.directory,"out"));
+        self.server.requests.clear();
+        self.assertEqual(self.runBatch(["a","b"]),0);
+        self.assertEqual(self.outputs(),["1.blast","2.blast"]);
+        self.assertEqual(sum(self.server.requests.values()),0);
+
+if __name__ == "__main__":
+    unittest.main()
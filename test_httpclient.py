@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#tests of httpclient.py against a local HTTP stand-in, run with: python3 -m unittest test_httpclient
+
+import time
+import threading
+import unittest
+import collections
+import http.server
+from unittest import mock
+import requests
+import httpclient
+
+class StandIn(http.server.BaseHTTPRequestHandler):
+    """
+    Answers by path: /ok 200, /flaky/N 503 for the first N requests then 200, /busy/N 429 then 200,
+    /slow waits longer than the tests' read timeout, /always503 503
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self,*args):
+        pass
+
+    def reply(self,status,body=b"ok"):
+        self.send_response(status);
+        self.send_header("Content-Length",str(len(body)));
+        if (status == 429): self.send_header("Retry-After","0");
+        self.end_headers();
+        self.wfile.write(body);
+
+    def handle_any(self):
+        server = self.server;
+        length = int(self.headers.get("Content-Length") or 0);
+        if (length): self.rfile.read(length);
+        with server.lock:
+            server.requests[self.path] += 1;
+            count = server.requests[self.path];
+            server.clients.append(self.client_address);
+            server.headers.append(dict(self.headers));
+        parts = self.path.strip("/").split("/");
+        if (parts[0] == "slow"):
+            time.sleep(1);
+            try:
+                return self.reply(200);
+            except (BrokenPipeError,ConnectionResetError):
+                return; #the client gave up waiting
+        if (parts[0] == "always503"): return self.reply(503);
+        if (parts[0] in ("flaky","busy") and count <= int(parts[1])): return self.reply(503 if parts[0] == "flaky" else 429);
+        self.reply(200,("%s %d" % (self.command,count)).encode());
+
+    do_GET = handle_any
+    do_POST = handle_any
+
+class HttpClientTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1",0),StandIn);
+        cls.server.daemon_threads = True;
+        cls.server.lock = threading.Lock();
+        cls.thread = threading.Thread(target=cls.server.serve_forever,daemon=True);
+        cls.thread.start();
+        cls.base = "http://127.0.0.1:%d" % cls.server.server_address[1];
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown();
+        cls.server.server_close();
+
+    def setUp(self):
+        self.server.requests = collections.Counter();
+        self.server.clients = [];
+        self.server.headers = [];
+        #no waiting between attempts
+        patcher = mock.patch.object(httpclient,"backoff",return_value=0);
+        self.backoff = patcher.start();
+        self.addCleanup(patcher.stop);
+
+    def test_get_retries_server_errors(self):
+        r = httpclient.get(self.base + "/flaky/2");
+        self.assertEqual(r.status_code,200);
+        self.assertEqual(self.server.requests["/flaky/2"],3);
+
+    def test_retries_are_bounded(self):
+        r = httpclient.get(self.base + "/always503",retries=2);
+        self.assertEqual(r.status_code,503);
+        self.assertEqual(self.server.requests["/always503"],3);
+
+    def test_post_is_not_sent_twice_after_server_error(self):
+        r = httpclient.post(self.base + "/flaky/1",data={"CMD":"Put"});
+        self.assertEqual(r.status_code,503);
+        self.assertEqual(self.server.requests["/flaky/1"],1);
+
+    def test_idempotent_post_is_retried(self):
+        r = httpclient.post(self.base + "/flaky/1",data={"id":"a"},idempotent=True);
+        self.assertEqual(r.status_code,200);
+        self.assertEqual(self.server.requests["/flaky/1"],2);
+
+    def test_post_is_retried_when_rate_limited(self):
+        r = httpclient.post(self.base + "/busy/1",data={"CMD":"Put"});
+        self.assertEqual(r.status_code,200);
+        self.assertEqual(self.server.requests["/busy/1"],2);
+
+    def test_post_is_not_sent_twice_after_timeout(self):
+        with self.assertRaises(requests.Timeout):
+            httpclient.post(self.base + "/slow",data={"CMD":"Put"},timeout=(2,0.2));
+        self.assertEqual(self.server.requests["/slow"],1);
+
+    def test_get_is_retried_after_timeout(self):
+        with self.assertRaises(requests.Timeout):
+            httpclient.get(self.base + "/slow",timeout=(2,0.2),retries=1);
+        self.assertEqual(self.server.requests["/slow"],2);
+
+    def test_post_is_retried_when_the_connection_fails(self):
+        #a port nobody listens on: the request never reached a server
+        probe = http.server.HTTPServer(("127.0.0.1",0),StandIn);
+        port = probe.server_address[1];
+        probe.server_close();
+        with self.assertRaises(requests.ConnectionError):
+            httpclient.post("http://127.0.0.1:%d/" % port,data={"CMD":"Put"},retries=2);
+        self.assertEqual(self.backoff.call_count,2);
+
+    def test_retry_if(self):
+        r = httpclient.get(self.base + "/ok",retryIf=lambda r: r.text.endswith(" 1"));
+        self.assertEqual(r.text,"GET 2");
+
+    def test_streamed_response_is_closed_before_retry(self):
+        close = requests.Response.close;
+        with mock.patch.object(requests.Response,"close",autospec=True,side_effect=close) as closed:
+            with httpclient.get(self.base + "/flaky/2",stream=True) as r:
+                self.assertEqual(r.status_code,200);
+            self.assertGreaterEqual(closed.call_count,3);
+
+    def test_connections_are_reused_and_compression_asked_for(self):
+        httpclient.get(self.base + "/ok");
+        httpclient.get(self.base + "/ok");
+        self.assertEqual(len(set(self.server.clients)),1);
+        self.assertIn("gzip",self.server.headers[0].get("Accept-Encoding",""));
+
+if __name__ == "__main__":
+    unittest.main()
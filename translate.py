@@ -5,10 +5,22 @@ import re
 import sys
 import fileinput
 import argparse
+import itertools
+import heapq
+import collections
+import multiprocessing
+import os
 import util
+import extractfastaseq
 from argparse import RawTextHelpFormatter
 import sys
 
+#numpy is optional, it speeds up the six frame translation of long sequences
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
@@ -39,6 +51,27 @@ Translates the sequence and echos a warning to stderr for any sequences that are
 
 Translates the sequence provided on stdin
     cat sequence.fasta | translate.py
+
+Translates every sequence in a multi-fasta file (the options above apply to each sequence),
+the sequences are translated in parallel and written in input order
+    translate.py transcriptome.fasta -f > proteins.fasta
+
+Same as above using only 4 worker processes
+    translate.py transcriptome.fasta -f -j 4 > proteins.fasta
+
+Lists every open reading frame of at least 100 amino acids in all six frames, with its frame and its
+amino acid and nucleotide coordinates (1 based, nucleotide start > end on the reverse strand)
+    translate.py sequence.fasta --orfs --minlength 100
+
+Translates only the given windows of records in a fasta database, in one pass over the database (or through
+its extractfastaseq.py index). hits.tsv holds one tab separated record ID, frame, start, end per line, with
+coordinates as given by blast (1 based, negative frames translate the reverse complement). Only the strand is taken
+from the frame, the codons start at the first base of the window (the higher coordinate on the reverse strand)
+as they do in blast's hit coordinates
+    translate.py database.fasta --windows hits.tsv
+
+Lists the 3 longest ORFs of each sequence as a table (or as BED with --orfformat bed)
+    translate.py transcriptome.fasta --orfs --top 3 --orfformat tsv
 """
 
 parser = argparse.ArgumentParser(description=help,formatter_class=RawTextHelpFormatter)
@@ -50,6 +83,12 @@ parser.add_argument('-w', "--warn",dest="warnLength", default="50%",help='warn t
 parser.add_argument('-g', "--noregen",dest="regenerateFromThreePrime", action="store_const", const=False, default=True,help='Use the same codon groupings rather than regenerating the reading frame from the 3\' end (default is compatible with expasy and blast, with flag is compatible with emboss)')
 parser.add_argument('-o', "--orderByFrame",dest="orderByFrame", action="store_const", const=True, default=False,help='Order by frame index instead of match (used with -a)')
 parser.add_argument("--wrap",dest="wrap", type=int, default="60",help='Wrap the fasta to this width')
+parser.add_argument("--orfs",dest="orfs", action="store_const", const=True, default=False,help='list every open reading frame in all six frames (or the -r frame) with its coordinates')
+parser.add_argument("--minlength",dest="minLength", type=int, default=30,help='minimum ORF length in amino acids (used with --orfs, default 30)')
+parser.add_argument("--top",dest="top", type=int, default=None,help='only report the longest N ORFs per sequence (used with --orfs)')
+parser.add_argument("--orfformat",dest="orfFormat", choices=["fasta","tsv","bed"], default="fasta",help='ORF output: fasta, tsv (id, sequence, frame, aa start, aa end, nt start, nt end, length, protein) or bed')
+parser.add_argument("--windows",dest="windows", type=argparse.FileType('r'), default=None,help='tab separated file of: record ID, frame, start, end. Translates only these windows of the records in FILE')
+parser.add_argument('-j', "--jobs", type=int, default=os.cpu_count() or 1,help='Number of worker processes used when the input holds more than one sequence (default: number of cores)')
 
 mapping = {"UUU":"F", "UUC":"F", "UUA":"L", "UUG":"L",
     "UCU":"S", "UCC":"S", "UCA":"S", "UCG":"S",
@@ -105,14 +144,12 @@ def permute(sequence,independentReverseFrame):
     permutations.append(("-3",rcc));
     return permutations;
 
+#complement() drops anything that isn't a base (N, gaps..)
+nonBases = re.compile("[^AUCG]")
+complementTable = str.maketrans("AUCG","UAGC")
+
 def complement(sequence):
-    compl = "";
-    for c in sequence:
-        if (c == "A"): compl += "U";
-        if (c == "U"): compl += "A";
-        if (c == "C"): compl += "G";
-        if (c == "G"): compl += "C";
-    return compl;
+    return nonBases.sub("",sequence).translate(complementTable);
 
 def subdivide(seq):
     i = 0;
@@ -124,22 +161,12 @@ def subdivide(seq):
     return out
 
 def translate(sequence):
-    translated = "";
-    i=0;
-    while(i<len(sequence)):
-        if (len(sequence) < i+3 or "N" in sequence[i:i+3]):
-            translated += "X";
-        else:
-            translated += mapping[sequence[i:i+3]];
-        i+=3;
-    return translated;
+    #incomplete codons and codons with anything other than AUCG (N..) translate to X
+    return "".join([mapping.get(sequence[i:i+3],"X") for i in range(0,len(sequence),3)]);
 
 def detectDNA(sequence):
-    u = 0;
-    t = 0;
-    for c in sequence:
-        if (c is 'U'): u += 1;
-        if (c is 'T'): t += 1;
+    u = sequence.count("U");
+    t = sequence.count("T");
     if (u > 0 and t > 0):
         return None;
     if (u > 0):
@@ -149,61 +176,148 @@ def detectDNA(sequence):
 
     return None
 
+if numpy is not None:
+    #bases are encoded as 0-3 (in complement order: A+U = C+G = 3), anything else is 4
+    baseCodes = numpy.full(256,4,dtype=numpy.uint8);
+    for code,base in enumerate("ACGU"): baseCodes[ord(base)] = code;
+
+    #codons are packed as 16*first+4*second+third, entry 64 is used for the invalid/incomplete codon
+    codonTable = numpy.full(65,ord("X"),dtype=numpy.uint8);
+    for codon,aa in mapping.items():
+        codonTable[16*baseCodes[ord(codon[0])] + 4*baseCodes[ord(codon[1])] + baseCodes[ord(codon[2])]] = ord(aa);
+
+def translateCodes(codes):
+    "Translates an array of base codes, the numpy equivalent of translate()"
+    whole = len(codes) - len(codes) % 3;
+    codons = codes[:whole].reshape(-1,3).astype(numpy.intp);
+    packed = 16*codons[:,0] + 4*codons[:,1] + codons[:,2];
+    packed[(codons >= 4).any(axis=1)] = 64;
+    translated = codonTable[packed].tobytes().decode("ascii");
+    if (whole != len(codes)): translated += "X";
+    return translated;
+
+def translateFrames(sequence,independentReverseFrame):
+    """
+    Returns (name,translation) for all six frames, the same as translating each of permute()'s sequences
+    With numpy the sequence is encoded once and the reverse complement is built with array operations
+    """
+    if (numpy is None):
+        return [(name,translate(seq)) for name,seq in permute(sequence,independentReverseFrame)];
+
+    codes = baseCodes[numpy.frombuffer(sequence.encode("latin-1","replace"),dtype=numpy.uint8)];
+    reverse = (3 - codes[codes < 4])[::-1];
+    frames = [];
+    for frameIndex in range(3):
+        frames.append((str(frameIndex+1),translateCodes(codes[frameIndex:])));
+    for frameIndex in range(3):
+        start = frameIndex if independentReverseFrame else (len(sequence) - frameIndex) % 3;
+        frames.append((str(-frameIndex-1),translateCodes(reverse[start:])));
+    return frames;
+
 def dnaToRna(sequence):
     return sequence.replace("T","U");
 
 def countWithoutStop(translated):
-    count = 0;
-    maxCount = 0;
-    for c in translated:
-        if (c == '*'): count = 0;
-        count += 1;
-        if (count > maxCount): maxCount = count;
-    return maxCount;
+    #the stop codon counts towards the length of the piece that follows it
+    pieces = translated.split("*");
+    return max([len(pieces[0])] + [len(piece)+1 for piece in pieces[1:]]);
+
+def orfsInFrame(translated,minLength=0):
+    """
+    Yields (start,end) amino acid offsets (end exclusive, stop codon not included) of the open reading frames
+    in one translated frame: the piece before the first stop, then from the first M after each stop up to the next one
+    """
+    pos = 0;
+    while (True):
+        stop = translated.find("*",pos);
+        end = len(translated) if stop == -1 else stop;
+        start = pos if pos == 0 else translated.find("M",pos,end);
+        if (start != -1 and end - start >= minLength):
+            yield (start,end);
+        if (stop == -1): return;
+        pos = stop + 1;
 
 def extractLongestReadingFrame(translated):
-    frames = []
-    split = translated.split("*");
-    for index in range(split.__len__()):
-        tok = split[index]
-        if (index == 0):
-            frames.append((tok.__len__(),index,tok));
-        elif ("M" in tok):
-            first = tok.index("M")
-            frame = tok[first:];
-            frames.append((frame.__len__(),index,frame));
-
-    def getKey(item):
-        return item[0];
-    frames.sort(key=getKey,reverse=True);
-
-    for size,index,frame in frames:
-        return frame;
-
-def main():
-    args = parser.parse_args()
-    sequence = args.file.read()
-    header,_,remain = sequence.partition("\n");
-    if (header.startswith(">")):
-        sequence = remain;
+    start,end = max(orfsInFrame(translated),key=lambda orf: orf[1] - orf[0]);
+    return translated[start:end];
+
+def findOrfs(sequence,frames,independentReverseFrame,minLength=0,top=None):
+    """
+    Returns (frame,aaStart,aaEnd,ntStart,ntEnd,protein) for every ORF of at least minLength amino acids in the
+    translated frames, amino acid offsets are 0 based within the frame, nucleotide positions are 1 based and
+    inclusive on the forward strand (ntStart > ntEnd on the reverse strand, as in blast)
+    With top only the longest top ORFs are kept (longest first), selected with a bounded heap instead of a sort
+    """
+    reversePositions = None;
+    orfs = [];
+    for name,translated in frames:
+        frameIndex = abs(int(name)) - 1;
+        if (int(name) > 0):
+            offset = frameIndex;
+            frameLength = len(sequence) - offset;
+        else:
+            if (reversePositions is None):
+                #complement() drops non-bases so map reverse complement positions back through the kept bases
+                reversePositions = [i for i,c in enumerate(sequence) if c in "ACGU"][::-1];
+            offset = frameIndex if independentReverseFrame else (len(sequence) - frameIndex) % 3;
+            frameLength = len(reversePositions) - offset;
+        for aaStart,aaEnd in orfsInFrame(translated,minLength):
+            if (aaEnd == aaStart): continue;
+            first = offset + 3*aaStart;
+            last = offset + min(3*aaEnd,frameLength) - 1;
+            if (int(name) > 0):
+                ntStart, ntEnd = first + 1, last + 1;
+            else:
+                ntStart, ntEnd = reversePositions[first] + 1, reversePositions[last] + 1;
+            orfs.append((name,aaStart,aaEnd,ntStart,ntEnd,translated[aaStart:aaEnd]));
+    if (top is not None):
+        orfs = heapq.nlargest(top,orfs,key=lambda orf: orf[2] - orf[1]);
+    return orfs;
+
+def formatOrfs(header,orfs,orfFormat,wrap):
+    name = (header or ">sequence").partition(" ")[0].strip(">");
+    out = [];
+    if (orfFormat == "tsv"):
+        for i,(frame,aaStart,aaEnd,ntStart,ntEnd,protein) in enumerate(orfs):
+            out.append("%s_orf%d\t%s\t%s\t%d\t%d\t%d\t%d\t%d\t%s\n" % (name,i+1,name,frame,aaStart+1,aaEnd,ntStart,ntEnd,aaEnd-aaStart,protein));
+    elif (orfFormat == "bed"):
+        for i,(frame,aaStart,aaEnd,ntStart,ntEnd,protein) in enumerate(orfs):
+            strand = "+" if int(frame) > 0 else "-";
+            out.append("%s\t%d\t%d\t%s_orf%d\t%d\t%s\n" % (name,min(ntStart,ntEnd)-1,max(ntStart,ntEnd),name,i+1,min(aaEnd-aaStart,1000),strand));
     else:
-        header = None;
-            
-    sequence = sequence.replace("\n","").upper();
+        for i,(frame,aaStart,aaEnd,ntStart,ntEnd,protein) in enumerate(orfs):
+            out.append(">%s_orf%d frame:%s aa:%d-%d nt:%d-%d length:%d\n" % (name,i+1,frame,aaStart+1,aaEnd,ntStart,ntEnd,aaEnd-aaStart));
+            out.append(util.wrap(protein,wrap) + "\n");
+    return "".join(out);
+
+def translateRecord(record,options):
+    """
+    Translates one (header,sequence) record, header can be None
+    Returns (output,warnings,ok) so that records translated in worker processes can be written in input order
+    """
+    header,sequence = record;
+    args = argparse.Namespace(**options);
+    out = [];
+    err = [];
+
+    sequence = sequence.upper();
     isDna = detectDNA(sequence);
     if (isDna is None):
-        eprint("ERROR: Could not detect DNA/RNA");
-        sys.exit(1);
+        err.append("ERROR: Could not detect DNA/RNA%s\n" % (" in %s" % header if header else ""));
+        return "", "".join(err), False;
 
     if (isDna):
         sequence = dnaToRna(sequence);
 
-#print("IN SEQ         ",sequence)
-#print("IN SEQ         ",complement(sequence));
+    frames = translateFrames(sequence,args.regenerateFromThreePrime);
+    if (args.orfs):
+        if args.readingframe:
+            frames = [(name,translated) for name,translated in frames if int(name) == args.readingframe];
+        orfs = findOrfs(sequence,frames,args.regenerateFromThreePrime,args.minLength,args.top);
+        return formatOrfs(header,orfs,args.orfFormat,args.wrap), "", True;
+
     allTranslated = [];
-    for name,seq in permute(sequence,args.regenerateFromThreePrime):
-#print("translating",name.ljust(2),subdivide(seq));
-        translated = translate(seq);
+    for name,translated in frames:
         unbrokenLength = countWithoutStop(translated);
         if args.readingframe:
             if int(name) == args.readingframe:
@@ -223,23 +337,128 @@ def main():
             warnSize = longest * float(warnSize.strip("%"))/100
         warnSize = int(warnSize)
         if (unbrokenLength >= warnSize):
-            name,_,_ = header.partition(" ");
+            name,_,_ = (header or "").partition(" ");
             name = name.strip(">");
-            sys.stderr.write("Translate: long frame detected in %s length:%d (longest: %d)\n" % (name,unbrokenLength,allTranslated[0][0]));
+            err.append("Translate: long frame detected in %s length:%d (longest: %d)\n" % (name,unbrokenLength,allTranslated[0][0]));
 
     if (args.readingFrameOnly):
-        if (header): print(header,"[longest reading frame only]");
-        print(util.wrap(extractLongestReadingFrame(allTranslated[0][2]),args.wrap));
+        if (header): out.append("%s [longest reading frame only]\n" % header);
+        out.append(util.wrap(extractLongestReadingFrame(allTranslated[0][2]),args.wrap) + "\n");
     elif (not args.showAll):
-        if (header): print(header);
-        print(util.wrap(allTranslated[0][2],args.wrap));
+        if (header): out.append(header + "\n");
+        out.append(util.wrap(allTranslated[0][2],args.wrap) + "\n");
     else:
         #showall
         for trans in allTranslated:
             unbrokenLength, name, translated = trans;
-            print("Frame %s (max length %d)" % (name,unbrokenLength));
-            if (header): print(header)
-            print(translated);
-            print();
+            out.append("Frame %s (max length %d)\n" % (name,unbrokenLength));
+            if (header): out.append(header + "\n");
+            out.append(translated + "\n\n");
+    return "".join(out), "".join(err), True;
+
+def readRecords(f):
+    "Yields (header,sequence) for every fasta record, input without a header is read as a single sequence"
+    first = f.readline();
+    if (not first.startswith(">")):
+        yield None, (first + f.read()).replace("\n","");
+        return;
+    yield from extractfastaseq.fasta(itertools.chain([first],f));
+
+def translateRecords(records,options,jobs):
+    """
+    Yields translateRecord() results in input order
+    When there is more than one record they are spread over a pool of worker processes, at most a few
+    records per worker are in flight at any time so memory stays bounded on large inputs
+    """
+    records = iter(records);
+    first = next(records,None);
+    if (first is None): return;
+    second = next(records,None);
+    if (second is None or jobs <= 1):
+        for record in itertools.chain([first],[second] if second is not None else [],records):
+            yield translateRecord(record,options);
+        return;
+
+    with multiprocessing.Pool(jobs) as pool:
+        pending = collections.deque();
+        for record in itertools.chain([first,second],records):
+            pending.append(pool.apply_async(translateRecord,(record,options)));
+            if (len(pending) >= jobs*4): yield pending.popleft().get();
+        while (pending): yield pending.popleft().get();
+
+def readWindows(f):
+    """
+    Reads (id,frame,start,end) rows from a tab separated file, blank lines and lines starting with # are skipped
+    Raises ValueError naming the file and line of a row that isn't an ID and three numbers
+    """
+    windows = [];
+    for number,line in enumerate(f,1):
+        line = line.strip();
+        if (not line or line.startswith("#")): continue;
+        try:
+            id,frame,start,end = line.split("\t")[:4];
+            windows.append((id.strip(),int(frame),int(start),int(end)));
+        except ValueError:
+            raise ValueError("%s:%d: expected ID, frame, start, end" % (getattr(f,"name","windows"),number));
+    return windows;
+
+def translateWindow(sequence,frame,start,end):
+    """
+    Translates the 1 based inclusive nucleotide range start-end of a sequence (in either order, as blast hit
+    coordinates), negative frames translate the reverse complement of the range. Only the sign of frame is used,
+    the codons start at the start of the range on its strand
+    """
+    low,high = min(start,end),max(start,end);
+    window = sequence[low-1:high].upper();
+    if (detectDNA(window)): window = dnaToRna(window);
+    if (frame < 0): window = complement(window)[::-1];
+    return translate(window);
+
+def translateWindows(args):
+    try:
+        windows = readWindows(args.windows);
+    except ValueError as e:
+        parser.exit(1,"%s: error: %s\n" % (parser.prog,e));
+    byId = collections.defaultdict(list);
+    for i,window in enumerate(windows): byId[window[0]].append(i);
+    translations = {};
+    for id,header,sequence in extractfastaseq.lookupRecords(args.file,set(byId)):
+        for i in byId.get(id,()):
+            wid,frame,start,end = windows[i];
+            translations[i] = translateWindow(sequence,frame,start,end);
+
+    failed = False;
+    for i,(id,frame,start,end) in enumerate(windows):
+        if (i not in translations):
+            eprint("Not found: %s" % id);
+            failed = True;
+            continue;
+        print(">%s:%d-%d frame:%+d" % (id,start,end,frame));
+        print(util.wrap(translations[i],args.wrap));
+    if (failed): sys.exit(1);
+
+def main():
+    args = parser.parse_args()
+    if (args.windows):
+        translateWindows(args);
+        return;
+    options = dict(vars(args));
+    del options["file"];
+    del options["jobs"];
+
+    translatedAny = False;
+    failed = False;
+    for out,err,ok in translateRecords(readRecords(args.file),options,args.jobs):
+        translatedAny = True;
+        if (not ok): failed = True;
+        if (err):
+            sys.stdout.flush();
+            sys.stderr.write(err);
+        sys.stdout.write(out);
+    if (not translatedAny):
+        eprint("ERROR: Could not detect DNA/RNA");
+    if (failed or not translatedAny):
+        sys.exit(1);
 
-main();
+if __name__ == "__main__":
+    main();
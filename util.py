@@ -1,3 +1,9 @@
+import os
+import re
+import time
+import hashlib
+import shutil
+
 def wrap(string,width):
     if (width == 0): return string;
     out = "";
@@ -6,3 +12,151 @@ def wrap(string,width):
         string = string[width:]
     out += string
     return out
+
+class AhoCorasick:
+    "Multi-pattern substring matcher, finds which of many patterns occur in a text with one pass over the text"
+    def __init__(self,patterns):
+        self.goto = [{}];
+        self.fail = [0];
+        self.out = [[]];
+        for index,pattern in enumerate(patterns):
+            state = 0;
+            for c in pattern:
+                nxt = self.goto[state].get(c);
+                if (nxt is None):
+                    nxt = len(self.goto);
+                    self.goto[state][c] = nxt;
+                    self.goto.append({});
+                    self.fail.append(0);
+                    self.out.append([]);
+                state = nxt;
+            self.out[state].append(index);
+
+        queue = list(self.goto[0].values());
+        for state in queue:
+            for c,nxt in self.goto[state].items():
+                queue.append(nxt);
+                f = self.fail[state];
+                while (f and c not in self.goto[f]): f = self.fail[f];
+                target = self.goto[f].get(c,0);
+                self.fail[nxt] = target if target != nxt else 0;
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]];
+
+    def search(self,text):
+        "Returns the set of indices of the patterns found in text"
+        found = set();
+        state = 0;
+        goto = self.goto;
+        fail = self.fail;
+        out = self.out;
+        for c in text:
+            while (state and c not in goto[state]): state = fail[state];
+            state = goto[state].get(c,0);
+            if (out[state]): found.update(out[state]);
+        return found;
+
+def normalizeQuery(fasta):
+    "FASTA text reduced to what a search depends on: stripped headers and upper case sequences without whitespace"
+    records = [];
+    for record in re.split(r"\n(?=>)",fasta.strip()):
+        header,newline,sequence = record.partition("\n") if record.startswith(">") else ("",None,record);
+        records.append(header.strip() + "\n" + re.sub(r"\s","",sequence).upper());
+    return "\n".join(records);
+
+def isBlastXml(text):
+    "Whether text is a complete blast XML result, not an error page or a cut off download"
+    text = text.strip();
+    return text.startswith(("<?xml","<BlastOutput")) and "<BlastOutput" in text[:4096] and text.endswith("</BlastOutput>");
+
+def isBlastXmlFile(path):
+    "isBlastXml() for a file, only its start and end are read"
+    try:
+        with open(path,"rb") as f:
+            head = f.read(4096);
+            f.seek(max(len(head),os.fstat(f.fileno()).st_size - 4096));
+            tail = f.read();
+    except OSError:
+        return False;
+    return isBlastXml((head + tail).decode("utf-8","replace"));
+
+RESULT_CACHE_DIR = os.path.join(os.path.expanduser("~"),".cache","blastresults")
+
+class ResultCache:
+    """
+    Search results stored on disk under the sha1 of everything the search depends on, see key()
+    Entries older than ttl seconds are misses, and after each store the least recently used entries are removed
+    until the cache is at most maxSize bytes. Neither limit applies when it is None
+    """
+    def __init__(self,directory=RESULT_CACHE_DIR,ttl=None,maxSize=None):
+        self.directory = directory;
+        self.ttl = ttl;
+        self.maxSize = maxSize;
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha1("\0".join(["" if part is None else str(part) for part in parts]).encode("utf-8")).hexdigest();
+
+    def path(self,key):
+        return os.path.join(self.directory,key[:2],key);
+
+    def getPath(self,key):
+        "Returns the path of the cached result for key, None when there is none or it is too old"
+        path = self.path(key);
+        try:
+            st = os.stat(path);
+            if (self.ttl is not None and time.time() - st.st_mtime > self.ttl): return None;
+            #the access time records use for eviction, the modification time stays the age of the result
+            os.utime(path,(time.time(),st.st_mtime));
+            return path;
+        except OSError:
+            return None;
+
+    def get(self,key):
+        path = self.getPath(key);
+        if (path is None): return None;
+        try:
+            with open(path) as f:
+                return f.read();
+        except OSError:
+            return None;
+
+    def put(self,key,text):
+        def write(tmp):
+            with open(tmp,"w") as f:
+                f.write(text);
+        self.store(key,write);
+
+    def putFile(self,key,source):
+        "Caches a copy of the file source for key"
+        self.store(key,lambda tmp: shutil.copyfile(source,tmp));
+
+    def store(self,key,write):
+        path = self.path(key);
+        try:
+            os.makedirs(os.path.dirname(path),exist_ok=True);
+            tmp = "%s.%d.tmp" % (path,os.getpid());
+            write(tmp);
+            os.replace(tmp,path);
+            self.evict();
+        except OSError:
+            pass #read only location, just don't cache
+
+    def evict(self):
+        if (self.maxSize is None): return;
+        entries = [];
+        for root,dirs,files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root,name);
+                try:
+                    st = os.stat(path);
+                except OSError:
+                    continue;
+                entries.append((st.st_atime,st.st_size,path));
+        total = sum([size for atime,size,path in entries]);
+        for atime,size,path in sorted(entries):
+            if (total <= self.maxSize): break;
+            try:
+                os.remove(path);
+            except OSError:
+                pass
+            total -= size;
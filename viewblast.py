@@ -1,17 +1,33 @@
 #!/usr/bin/env python
 
-import requests
+import httpclient
+import util
 import urllib
+import urllib.parse
 import re
 import time
 import sys
 import os.path
 import argparse
+import collections
+import hashlib
+import io
+import json
+import functools
+import glob
+import heapq
+import operator
+import itertools
+import mmap
+import select
+import subprocess
+import multiprocessing
 import xml.etree.ElementTree as ET
 from argparse import RawTextHelpFormatter
 
 help="""
-This script lets you extract results and information from blast results stored as XML
+This script lets you extract results and information from blast results stored as XML (-outfmt 5),
+tabular text (-outfmt 6 or 7) or JSON (-outfmt 15), the format is detected from the input
 
 The format parameter can be any strings. The following sequences can be used to insert record information:
     {Hit_num} {Hit_id} {Hit_def} {Hit_accession} {Hit_len} {Hit_hsps/Hsp/Hsp_num} {Hit_hsps/Hsp/Hsp_bit-score} {Hit_hsps/Hsp/Hsp_score}
@@ -26,6 +42,26 @@ of particular use are
     {Hit_accession} - replaced with the accession number as known by the database, if blasting against NCBI this is a GB accession
     {e} - replaced with the evalue of the first "sub hit"
     {cover} - replaced with the query coverage of all "sub hits"
+    {cover_q_bases} - replaced with the number of query bases covered by all "sub hits"
+    {cover_hit} - replaced with the coverage of the hit sequence (Hit_len) by all "sub hits"
+    {Iteration_query-ID} {Iteration_query-def} {Iteration_query-len} - replaced with information on the query of the result
+Fields that a result doesn't have are shown as -
+
+Tabular results are read with the default -outfmt 6 columns unless --columns gives the ones used for the blast,
+outfmt 7 files name their own columns. Rows of the same query and subject are one result with several HSPs.
+Text that is neither XML nor JSON and whose first row doesn't have those columns (with a numeric evalue and bitscore)
+is rejected as an unrecognized format.
+The columns map onto the XML fields above (qseqid/qaccver: Iteration_query-ID, qlen: Iteration_query-len,
+sseqid: Hit_id, saccver/sacc: Hit_accession, stitle: Hit_def, slen: Hit_len, evalue: Hsp_evalue, qstart: Hsp_query-from..),
+other columns can be used by name in HSP formats. {cover} needs the qlen column
+    viewblast.py list out.tsv --columns 'qaccver saccver evalue bitscore qstart qend sstart send qlen slen' -f '{Hit_accession}\t{e}\t{cover}'
+
+Blast files with several queries: results are numbered across all queries, coverage uses each result's own query.
+Show the first 3 results of every query
+    viewblast.py list multi.blast --per-query 3 -f '{Iteration_query-def}\t{Hit_accession}\t{e}\t{cover}'
+
+Show the 2nd result of the query with ID Query_12 (results are numbered within the selected query)
+    viewblast.py info 2 multi.blast -q Query_12
 
 Show the accession number and the evalue of the top 5 results separated by commas
     viewblast.py list out.blast -n 5 -f '{Hit_accession},{e}'
@@ -42,59 +78,307 @@ Returns the "{Hit_accession}" of the first result
 Returns only the fasta header "Hit_def" field of the first result
     viewblast.py info 1 out.blast -f '{Hit_def}'
 
+Returns the evalue, id, fasta header and accession of results 1 to 20 (and 25) as one tab separated row per result,
+starting with the result number, in a single pass over the file. Use -o json for one JSON object per line instead
+    viewblast.py info 1-20,25 out.blast --fields e,Hit_id,Hit_def,Hit_accession
+
+Returns the accession of every result from the 10th on, formatted like a single result
+    viewblast.py info 10- out.blast -f '{Hit_num} {Hit_accession}'
+
 Returns a list of all result accession numbers from the blast
     viewblast.py list out.blast -f '{Hit_accession}'
 
 This only works with an NCBI blast, it uses the result Hit_accession number to then look up the contig on GenBank
     viewblast.py contig 1 out.blast
 
+Contigs of several results are fetched together in batched requests, use all to select every result and
+-e to only keep results who's E-value is less than or equal to the provided evalue
+    viewblast.py contig 1-20 out.blast
+    viewblast.py contig all out.blast -e '1e-50'
+
+Fetched contigs are kept in ~/.cache/viewblast/contigs and later lookups of the same accessions are served from there
+
 Only show results who's E-value is less than or equal to the provided evalue
     viewblast.py list out.blast -e '1e-50'
 
+Filter the results with comparisons (< <= > >= == != and ~ for "contains", !~ for "doesn't contain") of format fields, combined with and, or,
+not and brackets. Besides the format fields above, HSP fields of the first HSP can be named without Hit_hsps/Hsp/Hsp_
+(evalue, bit-score, identity, align-len..), frame is the hit frame
+    viewblast.py list out.blast -w 'evalue<1e-50 and cover>=60 and frame==+2'
+    viewblast.py list out.blast -w 'Hit_def~opsin or (bit-score>200 and not Hit_def~"partial cds")'
+
+Sort the results on a field, ascending unless desc is given, -n then keeps only the top results
+    viewblast.py list out.blast --sort 'bit-score desc' -n 10
+
 Output the list of HSPs from the 2nd hit
     viewblast.py hsp 2 result.blast
 
 Format the list of HSPs from the 2nd hit
     viewblast.py hsp 2 result.blast -f '{Hsp_num} {Hsp_score} {Hsp_evalue} {Hsp_hit-frame}'
 
+Summarise a whole directory (or glob) of result files at once, in parallel. Every row starts with the file and the
+query, the -w, -e and -s options work like those of list but over all the files together and -n shows that many rows.
+Directories are read for their *.blast, *.xml, *.tsv and *.json files (-p for others), files that aren't blast
+results are reported and skipped
+    viewblast.py corpus blasts -e '1e-100' -f '{Hit_accession}\t{Hit_def}'
+    viewblast.py corpus 'blasts/*.blast' -s 'bit-score desc' -n 20
+
 Get help on the various options
     viewblast.py info -h
     viewblast.py contig -h
     viewblast.py hsp -h
     viewblast.py list -h
+    viewblast.py corpus -h
+
+The parsed hits are cached next to the blast file (out.blast.vbcache) so that repeated calls on the same file
+skip the XML parsing, the cache is rebuilt whenever the file changes. info 1 or list -n 5 still stop reading early
+and leave the rest of the file to a cache command started in the background. Piped results are cached by their
+content in ~/.cache/viewblast/parsed (the most recently used 512 MB, for up to 30 days) when the whole input is
+already waiting (eg: cat out.blast | viewblast.py ..), input that is still arriving is parsed as it comes. Piped
+input is only cached once all of it has been read. To neither read nor write the cache:
+    viewblast.py info 1 out.blast --nocache
+
+Parse files into their caches ahead of time
+    viewblast.py cache blasts/*.blast
 
 You can of course, pipe in a blast result directly. This command gets the first 5 results of the blast
 tblastn -db tsa_nt -query query.txt -remote | viewblast.py list -n 5
 """
 
+def indexRanges(spec):
+    "argparse type for result selections: 3, 1-20, 1,4,7-9, 5- (to the end) or all, returned as inclusive (first,last) pairs"
+    if (spec == "all"): return [(1,None)];
+    ranges = [];
+    try:
+        for part in spec.split(","):
+            first,dash,last = part.strip().partition("-");
+            first = int(first);
+            last = (int(last) if last else None) if dash else first;
+            ranges.append((first,last));
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid result selection: %s" % spec);
+    return ranges;
+
+#short names of filter and sort fields
+fieldAliases = {
+    "frame":"Hit_hsps/Hsp/Hsp_hit-frame"
+}
+
+#format fields that need the HSP coverage computed, filters on these are evaluated last
+EXPENSIVE_FIELDS = ("cover","cover_hit","cover_q_bases","multiframe")
+
+def filterAccessor(name):
+    "Returns (accessor,cost) for a field of a filter or sort expression, see fieldAccessor"
+    name = fieldAliases.get(name,name);
+    if (name in computedFields or name.startswith(("Hit_","Iteration_"))):
+        return fieldAccessor(name), 1 if name in EXPENSIVE_FIELDS else 0;
+    #a bare name: an HSP field of the first HSP (evalue or a tabular column such as pident), else a hit or query field
+    candidates = ("Hsp_" + name,name);
+    def accessor(args,record):
+        hsp = record.hsps[0] if record.hsps else {};
+        for candidate in candidates:
+            if (candidate in hsp): return hsp[candidate];
+        return record.fields.get("Hit_" + name,record.query.get("Iteration_" + name));
+    return accessor, 0;
+
+def numericValue(text):
+    try:
+        return float(text.rstrip("%"));
+    except (ValueError,AttributeError):
+        return None;
+
+filterOperators = {
+    "<":operator.lt, "<=":operator.le, ">":operator.gt, ">=":operator.ge,
+    "==":operator.eq, "=":operator.eq, "!=":operator.ne, "~":lambda a,b: b in a, "!~":lambda a,b: b not in a
+}
+
+#quoted strings, brackets, operators and words (which can't start with a quote)
+FILTER_TOKEN = re.compile(r"""\s*("[^"]*"|'[^']*'|\(|\)|<=|>=|==|!=|!~|[<>=~]|[^\s()<>=!~"'][^\s()<>=!~]*)""")
+
+def filterTokens(text):
+    "Splits a filter expression into tokens, anything that isn't one (a lone !, an unclosed quote) is an error"
+    tokens = [];
+    position = 0;
+    while (text[position:].strip()):
+        match = FILTER_TOKEN.match(text,position);
+        if (match is None):
+            position += len(text[position:]) - len(text[position:].lstrip());
+            raise argparse.ArgumentTypeError("unexpected %s at position %d in filter: %s" % (text[position],position + 1,text));
+        tokens.append(match.group(1));
+        position = match.end();
+    return tokens;
+
+def comparison(name,op,value):
+    "Returns (predicate,cost) comparing a field to a value, numerically when both sides are numbers"
+    accessor,cost = filterAccessor(name);
+    compare = filterOperators[op];
+    number = numericValue(value);
+    def predicate(args,record):
+        field = accessor(args,record);
+        if (field is None): return op in ("!=","!~");
+        if (op not in ("~","!~") and number is not None):
+            fieldNumber = numericValue(field);
+            if (fieldNumber is not None): return compare(fieldNumber,number);
+        return compare(field,value);
+    return predicate, cost;
+
+def combine(predicates,any_):
+    "and/or of (predicate,cost) pairs, cheapest first so expensive fields are only computed for hits still in question"
+    predicates = sorted(predicates,key=lambda p: p[1]);
+    functions = [p for p,cost in predicates];
+    if (any_): return (lambda args,record: any(p(args,record) for p in functions)), predicates[-1][1];
+    return (lambda args,record: all(p(args,record) for p in functions)), predicates[-1][1];
+
+def filterExpression(text):
+    """
+    argparse type for filter expressions, eg: 'evalue<1e-50 and cover>=60 and frame==+2'
+    Returns a predicate (args,hit) -> bool
+    """
+    tokens = filterTokens(text);
+    position = [0];
+    def peek():
+        return tokens[position[0]] if position[0] < len(tokens) else None;
+    def take():
+        token = peek();
+        if (token is None): raise argparse.ArgumentTypeError("incomplete filter: %s" % text);
+        position[0] += 1;
+        return token;
+    def parseOr():
+        predicates = [parseAnd()];
+        while (peek() == "or"):
+            take();
+            predicates.append(parseAnd());
+        return predicates[0] if len(predicates) == 1 else combine(predicates,True);
+    def parseAnd():
+        predicates = [parseNot()];
+        while (peek() == "and"):
+            take();
+            predicates.append(parseNot());
+        return predicates[0] if len(predicates) == 1 else combine(predicates,False);
+    def parseNot():
+        token = take();
+        if (token == "not"):
+            predicate,cost = parseNot();
+            return (lambda args,record: not predicate(args,record)), cost;
+        if (token == "("):
+            predicate = parseOr();
+            if (take() != ")"): raise argparse.ArgumentTypeError("missing ) in filter: %s" % text);
+            return predicate;
+        op = take();
+        if (op not in filterOperators): raise argparse.ArgumentTypeError("expected a comparison after %s in filter: %s" % (token,text));
+        value = take();
+        if (value[:1] in ("'",'"') and len(value) > 1): value = value[1:-1];
+        return comparison(token,op,value);
+    predicate,cost = parseOr();
+    if (peek() is not None): raise argparse.ArgumentTypeError("unexpected %s in filter: %s" % (peek(),text));
+    return predicate;
+
+def sortSpec(text):
+    "argparse type for sort orders: a field and optionally asc or desc, eg: 'bit-score desc'"
+    spec = text.split();
+    if (len(spec) not in (1,2) or (len(spec) == 2 and spec[1] not in ("asc","desc"))):
+        raise argparse.ArgumentTypeError("sort takes a field and optionally asc or desc: %s" % text);
+    return spec;
+
 parser = argparse.ArgumentParser(description=help,formatter_class=RawTextHelpFormatter)
 command_subparser = parser.add_subparsers(help="View mode")
 
-info_parser = command_subparser.add_parser("info",help="View a single result");
-info_parser.add_argument("index", type=int);
+#options shared by every view mode
+common_parser = argparse.ArgumentParser(add_help=False)
+common_parser.add_argument("-q","--query", default=None, help="Only use the hits of this query: an iteration number or query ID, or when no query has that number or ID, part of a query definition");
+common_parser.add_argument("--nocache", dest="cache", action="store_const", const=False, default=True, help='Do not use or write the parsed results and contig caches');
+common_parser.add_argument("--columns", default=None, help='Columns of tabular (-outfmt 6) results as given to blast, eg: "std qlen" (default: std)');
+common_parser.add_argument("-j","--jobs", type=int, default=os.cpu_count() or 1, help='Worker processes used to parse multi-query files (default: number of cores)');
+
+info_parser = command_subparser.add_parser("info",help="View a single result",parents=[common_parser]);
+info_parser.add_argument("index", type=indexRanges, help="Result number, or a list of numbers and ranges: 1-20,25,30-");
 info_parser.add_argument("-f","--format", help="Format of the response", default="{Hit_accession}");
-info_parser.add_argument('blast', type=argparse.FileType('r'), nargs="?", default=sys.stdin, help='the BLAST results file in XML')
+info_parser.add_argument("--fields", type=lambda s: s.split(","), default=None, help="Comma separated format fields (without braces) to output as one row per result eg: e,Hit_id,cover");
+info_parser.add_argument("-o","--output", choices=["tsv","json"], default="tsv", help="Row format used with --fields: tsv (default) or json lines");
+info_parser.add_argument('blast', type=argparse.FileType('r'), nargs="?", default=sys.stdin, help='the BLAST results file (XML, tabular or JSON)')
 
-hsp_parser = command_subparser.add_parser("hsp",help="List Hsp information from hit");
+hsp_parser = command_subparser.add_parser("hsp",help="List Hsp information from hit",parents=[common_parser]);
 hsp_parser.add_argument("index", type=int);
 hsp_parser.add_argument("-f","--format", help="Format of the response", default="[{Hsp_num}] score:{Hsp_score} e:{Hsp_evalue} frame:{Hsp_hit-frame}");
-hsp_parser.add_argument('blast', type=argparse.FileType('r'), nargs="?", default=sys.stdin, help='the BLAST results file in XML')
+hsp_parser.add_argument('blast', type=argparse.FileType('r'), nargs="?", default=sys.stdin, help='the BLAST results file (XML, tabular or JSON)')
 
-contig_parser = command_subparser.add_parser("contig",help="View a result's contig");
-contig_parser.add_argument("index", type=int);
-contig_parser.add_argument('blast', type=argparse.FileType('r'), nargs="?", default=sys.stdin, help='the BLAST results file in XML')
+contig_parser = command_subparser.add_parser("contig",help="View the contigs of results",parents=[common_parser]);
+contig_parser.add_argument("index", type=indexRanges, help="Result number, or a list of numbers and ranges: 1-20,25,30- or all");
+contig_parser.add_argument("-e","--ecutoff", type=str, help="Only fetch results with an E value of at most this");
+contig_parser.add_argument('blast', type=argparse.FileType('r'), nargs="?", default=sys.stdin, help='the BLAST results file (XML, tabular or JSON)')
 
-list_parser = command_subparser.add_parser("list",help="List the results");
+list_parser = command_subparser.add_parser("list",help="List the results",parents=[common_parser]);
 list_parser.add_argument("-f","--format", help="Format of the response", default="{Hit_id}\t{Hit_def}\t{Hit_hsps/Hsp/Hsp_evalue}\t{Hit_accession}");
 list_parser.add_argument("-n","--max", type=int, help="Number of records to show");
 list_parser.add_argument("-e","--ecutoff", type=str, help="Cut off at at a given E value");
-list_parser.add_argument('blast', type=argparse.FileType('r'), nargs="?", default=sys.stdin, help='the BLAST results file in XML')
+list_parser.add_argument("-w","--where", type=filterExpression, default=None, help="Only list results matching a filter expression eg: 'evalue<1e-50 and cover>=60'");
+list_parser.add_argument("-s","--sort", type=sortSpec, metavar="'FIELD [asc|desc]'", default=None, help="Sort the results on a field, eg: 'bit-score desc'");
+list_parser.add_argument("--per-query", dest="perQuery", type=int, default=None, help="Only use the first N hits of each query");
+list_parser.add_argument('blast', type=argparse.FileType('r'), nargs="?", default=sys.stdin, help='the BLAST results file (XML, tabular or JSON)')
+
+corpus_parser = command_subparser.add_parser("corpus",help="List the results of many files as one table",parents=[common_parser]);
+corpus_parser.add_argument("paths", nargs="+", help="Directories or globs of BLAST results files");
+corpus_parser.add_argument("-p","--pattern", default="*.blast,*.xml,*.tsv,*.json", help="Comma separated patterns of the files of a directory to read (default: *.blast,*.xml,*.tsv,*.json)");
+corpus_parser.add_argument("-f","--format", help="Format of the response", default="{Hit_accession}\t{e}\t{cover}\t{Hit_def}");
+corpus_parser.add_argument("-n","--max", type=int, help="Number of records to show, over all files");
+corpus_parser.add_argument("-e","--ecutoff", type=str, help="Cut off at at a given E value");
+#checked in corpus() and compiled again in the workers, filters don't pickle
+corpus_parser.add_argument("-w","--where", default=None, help="Only list results matching a filter expression eg: 'evalue<1e-50 and cover>=60'");
+corpus_parser.add_argument("-s","--sort", type=sortSpec, metavar="'FIELD [asc|desc]'", default=None, help="Sort the results of all files on a field");
+corpus_parser.add_argument("--per-query", dest="perQuery", type=int, default=None, help="Only use the first N hits of each query");
+
+cache_parser = command_subparser.add_parser("cache",help="Parse result files into their caches");
+cache_parser.add_argument("files", nargs="+", help="BLAST results files, files with an up to date cache are skipped");
+cache_parser.add_argument("--columns", default=None, help='Columns of tabular (-outfmt 6) results as given to blast, eg: "std qlen" (default: std)');
+cache_parser.add_argument("-j","--jobs", type=int, default=os.cpu_count() or 1, help='Worker processes used to parse multi-query files (default: number of cores)');
 
 
 def fetchContig(accession):
-    r = requests.get("http://www.ncbi.nlm.nih.gov/sviewer/viewer.cgi?sendto=on&dopt=fasta&val=%s" % accession);
+    r = httpclient.get("http://www.ncbi.nlm.nih.gov/sviewer/viewer.cgi?sendto=on&dopt=fasta&val=%s" % accession,
+                       retryIf=lambda r: "Resource temporarily unavailable" in r.text);
     return r.text.strip();
 
+EFETCH_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi"
+#accessions per efetch request
+CONTIG_BATCH_SIZE = 200
+
+def fastaRecords(text):
+    "Splits fasta text into (header,record) pairs"
+    for record in re.split(r"\n(?=>)",text.strip()):
+        if (record.startswith(">")):
+            yield record.split("\n",1)[0][1:], record.strip();
+
+def headerAccessions(header):
+    "The names a fasta header can be matched on: its ID, the parts of gi|..|gb|..| IDs and these without version"
+    words = header.split();
+    for name in (words[0].split("|") if words else []):
+        yield name;
+        yield name.split(".")[0];
+
+def fetchContigs(accessions):
+    """
+    Fetches the fasta of many accessions from NCBI with one efetch request per CONTIG_BATCH_SIZE accessions
+    Returns a dict of accession -> fasta, accessions a batch didn't return are fetched on their own with fetchContig
+    """
+    contigs = {};
+    for start in range(0,len(accessions),CONTIG_BATCH_SIZE):
+        batch = accessions[start:start + CONTIG_BATCH_SIZE];
+        wanted = {};
+        for accession in batch:
+            wanted.setdefault(accession,accession);
+            wanted.setdefault(accession.split(".")[0],accession);
+        #a read only query, safe to send again
+        r = httpclient.post(EFETCH_URL,data={"db":"nuccore","rettype":"fasta","retmode":"text","id":",".join(batch)},idempotent=True);
+        if (r.status_code != 200): continue;
+        for header,record in fastaRecords(r.text):
+            for name in headerAccessions(header):
+                if (name in wanted):
+                    contigs.setdefault(wanted[name],record);
+                    break;
+    for accession in accessions:
+        if (accession not in contigs): contigs[accession] = fetchContig(accession);
+    return contigs;
+
 def formatTable(output):
     lengths = [0] * len(output[0]);
     for row in output:
@@ -112,60 +396,42 @@ def formatTable(output):
             i += 1;
         print();
 
-def doFormat(formatString,root,othermapping):
-    for k,v in othermapping.items():
-        formatString = formatString.replace("{"+k+"}",v);
-    def replacementFunction(match):
-        return root.find(match.group(1)).text;
-    formatString = re.sub("{(.*?)}",replacementFunction,formatString);
-    return formatString;
-
-def addCoverage(coverage,seq):
-    inserted = False;
-    for i,cov in enumerate(coverage):
-        startsBefore = seq[0] < cov[0];
-
-        if (startsBefore):
-            inserted = True;
-            coverage.insert(i,seq);
-            break;
-    if (not inserted): coverage.append(seq);
-
-    i = -1;
-    while(i < len(coverage) - 2):
-        i += 1;
+def mergeIntervals(intervals):
+    "Returns the union of inclusive (start,end) intervals as sorted, disjoint intervals (sort and sweep)"
+    merged = [];
+    for start,end in sorted(intervals):
+        if (merged and start <= merged[-1][1]):
+            if (end > merged[-1][1]): merged[-1][1] = end;
+        else:
+            merged.append([start,end]);
+    return merged;
 
-        a = coverage[i];
-        b = coverage[i+1];
+def coveredBases(intervals):
+    return sum([end - start + 1 for start,end in mergeIntervals(intervals)]);
 
-        if (a[1] < b[0]): continue #no coalescing required, disparate
-        if (a[1] > b[1]):
-            coverage.pop(i+1);
-            i -= 1;
-            continue;
-
-        coverage[i] = (a[0],b[1]);
-        coverage.pop(i+1);
-        i -= 1;
+def hspRanges(hsps,fromField,toField):
+    "The (from,to) of every HSP, None when any of them lacks the fields (tabular results without those columns)"
+    ranges = [(hsp.get(fromField),hsp.get(toField)) for hsp in hsps];
+    if (any(a is None or b is None for a,b in ranges)): return None;
+    return [(int(a),int(b)) for a,b in ranges];
 
 def calculateCoverage(hsps):
-    coverage = [];
-    for hsp in hsps:
-        seq = (int(hsp.find("Hsp_query-from").text),int(hsp.find("Hsp_query-to").text))
-        addCoverage(coverage,seq);
-    
-    coverageCount = 0;
-    for seq in coverage:
-        diff = seq[1] - seq[0] + 1;
-        coverageCount += diff;
-    
-    return coverageCount;
+    ranges = hspRanges(hsps,"Hsp_query-from","Hsp_query-to");
+    return coveredBases(ranges) if ranges is not None else None;
+
+def calculateHitCoverage(hsps):
+    ranges = hspRanges(hsps,"Hsp_hit-from","Hsp_hit-to");
+    if (ranges is None): return None;
+    #hit coordinates run backwards on the reverse strand
+    return coveredBases([(min(a,b),max(a,b)) for a,b in ranges]);
 
 def calculateMultiframe(ecutoff,hsps):
+    "Whether HSPs within ecutoff are in different hit frames, None when the evalues or frames aren't known"
     frameOfHit = None;
     for hsp in hsps:
-        e = float(hsp.find("Hsp_evalue").text);
-        hitFrame = hsp.find("Hsp_hit-frame").text;
+        if (hsp.get("Hsp_evalue") is None or hsp.get("Hsp_hit-frame") is None): return None;
+        e = float(hsp["Hsp_evalue"]);
+        hitFrame = hsp["Hsp_hit-frame"];
         if (e <= float(ecutoff)):
             if (frameOfHit is not None):
                 if (frameOfHit != hitFrame):
@@ -173,105 +439,864 @@ def calculateMultiframe(ecutoff,hsps):
             frameOfHit = hitFrame;
     return False;
 
-def formatAlignment(args,root,alignment):
-    queryLength = int(root.find("BlastOutput_iterations/Iteration/Iteration_query-len").text);
-    isMultiframe = calculateMultiframe(args.ecutoff,alignment.findall("Hit_hsps/Hsp")) if (hasattr(args,"ecutoff") and args.ecutoff is not None) else False
-    multiframe = "MULTIFRAME" if isMultiframe else "";
-    hspCount = len(alignment.find("Hit_hsps").getchildren());
-    coverCount = calculateCoverage(alignment.findall("Hit_hsps/Hsp"));
-    coverage = "{:.0f}".format(100*float(coverCount) / float(queryLength)) + "%";
-    hitid = alignment.find("Hit_id").text;
-    hitdef = alignment.find("Hit_def").text;
-    accession = alignment.find("Hit_accession").text;
-    evalue = float(alignment.find("Hit_hsps/Hsp/Hsp_evalue").text);
-    fstring = args.format.replace("\\t","\t");
-    otherParams = {
-        "e":str(evalue),
-        "cover":coverage,
-        "hspCount":str(hspCount),
-        "multiframe":multiframe
-    }
-    fstring = doFormat(fstring,alignment,otherParams);
-    return fstring
+class Hit(collections.namedtuple("Hit",["fields","hsps","query"])):
+    """
+    A parsed hit: fields maps the Hit_* element names to their text, hsps is a list of Hsp_* name to text maps
+    and query maps the Iteration_* fields (Iteration_query-ID, Iteration_query-len..) of the query it belongs to
+    """
+    __slots__ = ()
 
-def hsp(args):
-    results = args.blast.read();
+    @property
+    def queryLength(self):
+        length = self.query.get("Iteration_query-len");
+        return int(length) if length else None;
+
+#Iteration children that aren't query information
+NOT_QUERY_FIELDS = ("Iteration_hits","Iteration_stat","Iteration_message")
+
+def hitFromElement(elem,query):
+    fields = {};
+    hsps = [];
+    for child in elem:
+        if (child.tag == "Hit_hsps"):
+            for hsp in child:
+                hsps.append({field.tag: field.text for field in hsp});
+        else:
+            fields[child.tag] = child.text;
+    return Hit(fields,hsps,query);
+
+def iterateXmlHits(blast):
+    """
+    Parses the blast XML incrementally, yielding a Hit for every hit in document order
+    Each Hit (and Iteration) element is cleared and dropped from the tree once it has been converted, so memory
+    stays constant however many hits there are, and a caller that stops early never reads the rest of the file.
+    """
+    defaultQueryLength = None;
+    query = {};
+    hitsParent = None;
+    iterationsParent = None;
+    for event,elem in ET.iterparse(blast,events=("start","end")):
+        tag = elem.tag;
+        if (event == "start"):
+            if (tag == "Iteration"): query = {};
+            elif (tag == "Iteration_hits"): hitsParent = elem;
+            elif (tag == "BlastOutput_iterations"): iterationsParent = elem;
+            continue;
+        if (tag == "Hit"):
+            #old blast versions only give the length of the (single) query in the header
+            query.setdefault("Iteration_query-len",defaultQueryLength);
+            hit = hitFromElement(elem,query);
+            elem.clear();
+            if (hitsParent is not None): hitsParent.remove(elem);
+            yield hit;
+        elif (tag.startswith("Iteration_") and tag not in NOT_QUERY_FIELDS):
+            query[tag] = elem.text;
+        elif (tag == "BlastOutput_query-len"):
+            defaultQueryLength = elem.text;
+        elif (tag == "Iteration"):
+            elem.clear();
+            if (iterationsParent is not None): iterationsParent.remove(elem);
+
+#the std columns of -outfmt 6
+STD_COLUMNS = "qaccver saccver pident length mismatch gapopen qstart qend sstart send evalue bitscore"
+
+#tabular columns and the query (Iteration_), hit (Hit_) or HSP (Hsp_) field they fill, other columns are kept by name in the HSP
+tabularFields = {
+    "qseqid":"Iteration_query-ID", "qaccver":"Iteration_query-ID", "qacc":"Iteration_query-ID", "qlen":"Iteration_query-len",
+    "sseqid":"Hit_id", "saccver":"Hit_accession", "sacc":"Hit_accession", "stitle":"Hit_def", "slen":"Hit_len",
+    "evalue":"Hsp_evalue", "bitscore":"Hsp_bit-score", "score":"Hsp_score", "length":"Hsp_align-len",
+    "nident":"Hsp_identity", "positive":"Hsp_positive", "gaps":"Hsp_gaps",
+    "qstart":"Hsp_query-from", "qend":"Hsp_query-to", "sstart":"Hsp_hit-from", "send":"Hsp_hit-to",
+    "qframe":"Hsp_query-frame", "sframe":"Hsp_hit-frame", "qseq":"Hsp_qseq", "sseq":"Hsp_hseq"
+}
+
+#the column descriptions of the "# Fields:" line of -outfmt 7
+tabularDescriptions = {
+    "query id":"qseqid", "query acc.":"qacc", "query acc.ver":"qaccver", "query length":"qlen",
+    "subject id":"sseqid", "subject ids":"sallseqid", "subject acc.":"sacc", "subject acc.ver":"saccver",
+    "subject length":"slen", "subject title":"stitle", "subject titles":"salltitles",
+    "% identity":"pident", "alignment length":"length", "mismatches":"mismatch", "gap opens":"gapopen", "gaps":"gaps",
+    "q. start":"qstart", "q. end":"qend", "s. start":"sstart", "s. end":"send", "evalue":"evalue",
+    "bit score":"bitscore", "score":"score", "identical":"nident", "positives":"positive", "% positives":"ppos",
+    "query frame":"qframe", "sbjct frame":"sframe", "query/sbjct frames":"frames", "query seq":"qseq", "subject seq":"sseq",
+    "subject strand":"sstrand", "% query coverage per subject":"qcovs", "% query coverage per hsp":"qcovhsp"
+}
+
+def tabularColumns(spec):
+    "Returns the column names of a -outfmt column specification, eg: '6 std qlen' or 'qseqid,sseqid,evalue'"
+    columns = [];
+    for column in (spec or STD_COLUMNS).replace(","," ").split():
+        if (column in ("6","7")): continue;
+        columns.extend(STD_COLUMNS.split() if column == "std" else [column]);
+    return columns;
+
+def iterateTabularHits(lines,columns=None):
+    """
+    Parses tabular (-outfmt 6 or 7) blast results line by line, yielding a Hit for each run of rows with the
+    same query and subject, numbered from 1 within each query like the XML
+    """
+    columns = tabularColumns(columns);
+    queryDef = None;
+    query = None;
+    hit = None;
+    hitKey = None;
+    iteration = 0;
+    for line in lines:
+        if (line.startswith("#")):
+            text = line[1:].strip();
+            if (text.startswith("Fields:")):
+                columns = [tabularDescriptions.get(d.strip(),d.strip()) for d in text[len("Fields:"):].split(",")];
+            elif (text.startswith("Query:")):
+                queryDef = text[len("Query:"):].strip();
+            continue;
+        if (not line.strip()): continue;
+        queryFields = {};
+        hitFields = {};
+        hsp = {};
+        for column,value in zip(columns,line.rstrip("\r\n").split("\t")):
+            field = tabularFields.get(column,column);
+            if (field.startswith("Iteration_")): queryFields.setdefault(field,value);
+            elif (field.startswith("Hit_")): hitFields.setdefault(field,value);
+            else: hsp.setdefault(field,value);
+
+        queryKey = (queryFields.get("Iteration_query-ID"),queryDef);
+        if (query is None or queryKey != (query.get("Iteration_query-ID"),query.get("Iteration_query-def"))):
+            if (hit is not None): yield hit;
+            iteration += 1;
+            query = {"Iteration_iter-num":str(iteration)};
+            query.update(queryFields);
+            if (queryDef is not None): query["Iteration_query-def"] = queryDef;
+            hit = None;
+            hitNum = 0;
+
+        key = (hitFields.get("Hit_id"),hitFields.get("Hit_accession"));
+        if (hit is None or key != hitKey):
+            if (hit is not None): yield hit;
+            hitNum += 1;
+            hitFields["Hit_num"] = str(hitNum);
+            #without an accession column the subject id is the closest thing
+            if ("Hit_id" in hitFields): hitFields.setdefault("Hit_accession",hitFields["Hit_id"]);
+            if ("Hit_accession" in hitFields): hitFields.setdefault("Hit_id",hitFields["Hit_accession"]);
+            hit = Hit(hitFields,[],query);
+            hitKey = key;
+        hsp["Hsp_num"] = str(len(hit.hsps) + 1);
+        hit.hsps.append(hsp);
+    if (hit is not None): yield hit;
+
+def iterateJsonHits(text):
+    "Parses BLAST JSON (-outfmt 15) results, yielding a Hit for every hit with the fields named as in the XML"
+    data = json.loads(text);
+    reports = data.get("BlastOutput2",data) if isinstance(data,dict) else data;
+    if (isinstance(reports,dict)): reports = [reports];
+    iteration = 0;
+    for report in reports:
+        results = report.get("report",report).get("results",{});
+        searches = [results["search"]] if "search" in results else [i["search"] for i in results.get("iterations",[])];
+        for search in searches:
+            iteration += 1;
+            query = {"Iteration_iter-num":str(iteration)};
+            for key,field in (("query_id","Iteration_query-ID"),("query_title","Iteration_query-def"),("query_len","Iteration_query-len")):
+                if (key in search): query[field] = str(search[key]);
+            for hit in search.get("hits",[]):
+                description = hit["description"][0] if hit.get("description") else {};
+                fields = {};
+                for field,value in (("Hit_num",hit.get("num")),("Hit_id",description.get("id")),("Hit_def",description.get("title")),
+                                    ("Hit_accession",description.get("accession")),("Hit_len",hit.get("len"))):
+                    if (value is not None): fields[field] = str(value);
+                #bit_score -> Hsp_bit-score, query_from -> Hsp_query-from..
+                hsps = [{"Hsp_" + key.replace("_","-"): str(value) for key,value in hsp.items()} for hsp in hit.get("hsps",[])];
+                yield Hit(fields,hsps,query);
+
+class PrefixedReader:
+    "A readable that returns text already read from a stream before the rest of the stream"
+    def __init__(self,prefix,stream):
+        self.prefix = prefix;
+        self.stream = stream;
+
+    def read(self,size=-1):
+        if (not self.prefix): return self.stream.read(size);
+        if (size is None or size < 0):
+            data = self.prefix + self.stream.read();
+            self.prefix = "";
+            return data;
+        data = self.prefix[:size];
+        self.prefix = self.prefix[size:];
+        return data;
+
+def isTabularRow(line,columns=None):
+    "Whether a line is a row of tabular results: one tab separated value per column, with numeric evalue and bitscore"
+    names = tabularColumns(columns);
+    values = line.rstrip("\r\n").split("\t");
+    if (len(values) != len(names)): return False;
+    return all(numericValue(value) is not None for name,value in zip(names,values) if name in ("evalue","bitscore"));
+
+def sniffFormat(blast,columns=None):
+    """
+    Reads the start of blast up to its first line of results, returning the format ('xml', 'json', 'tabular',
+    None when empty, 'unknown' for anything else) and the text read
+    Text is only tabular with the comment header of -outfmt 7 or when its first row fits the --columns
+    """
+    head = "";
+    comments = [];
+    while True:
+        line = blast.readline();
+        if (not line): break;
+        head += line;
+        text = line.strip();
+        if (not text): continue;
+        if (not comments and text[0] == "<"): return "xml", head;
+        if (not comments and text[0] in "{["): return "json", head;
+        if (text[0] != "#"): break;
+        comments.append(text);
+    if (not head.strip()): return None, head;
+    #the header of -outfmt 7 starts with the program (# TBLASTN 2.12.0+) and names the columns when there are hits
+    if (comments and (re.match(r"#\s*\w*BLAST",comments[0]) or any(c[1:].strip().startswith("Fields:") for c in comments))):
+        return "tabular", head;
+    return ("tabular" if line and isTabularRow(line,columns) else "unknown"), head;
+
+def iterateHits(blast,columns=None):
+    """
+    Returns an iterator over the Hits of a blast input in any of the supported formats
+    XML and tabular input are parsed incrementally. Exits with status 1 (like the old full parse) when the input is
+    empty or in none of the formats
+    """
+    kind,head = sniffFormat(blast,columns);
+    if (kind is None): exit(1);
+    if (kind == "unknown"):
+        sys.stderr.write("%s: unrecognized format, expected blast XML, JSON or tabular results with the columns %s\n" %
+                         (getattr(blast,"name","<stdin>"),columns or "std"));
+        exit(1);
+    if (kind == "json"): return iterateJsonHits(head + blast.read());
+    if (kind == "tabular"): return iterateTabularHits(itertools.chain(head.splitlines(True),blast),columns);
+    return iterateXmlHits(PrefixedReader(head,blast));
+
+def iterationRanges(path):
+    "Returns the byte ranges of the <Iteration> elements of a blast XML file and the header's query length"
+    with open(path,"rb") as f:
+        if (os.fstat(f.fileno()).st_size == 0): return [], None;
+        with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mm:
+            if (mm[:4096].lstrip()[:1] != b"<"): return [], None;
+            ranges = [];
+            pos = mm.find(b"<Iteration>");
+            match = re.search(rb"<BlastOutput_query-len>(\d+)<",mm[:pos if pos != -1 else 65536]);
+            while (pos != -1):
+                end = mm.find(b"</Iteration>",pos);
+                if (end == -1): break;
+                end += len(b"</Iteration>");
+                ranges.append((pos,end));
+                pos = mm.find(b"<Iteration>",end);
+    return ranges, match.group(1).decode() if match else None;
+
+def parseIterations(task):
+    "Worker: parses a batch of <Iteration> byte ranges of a file, returning its hits as plain tuples"
+    path,ranges,defaultQueryLength = task;
+    hits = [];
+    with open(path,"rb") as f:
+        for start,end in ranges:
+            f.seek(start);
+            iteration = ET.fromstring(f.read(end - start));
+            query = {child.tag: child.text for child in iteration if child.tag.startswith("Iteration_") and child.tag not in NOT_QUERY_FIELDS};
+            query.setdefault("Iteration_query-len",defaultQueryLength);
+            for elem in iteration.iterfind("Iteration_hits/Hit"):
+                hits.append(tuple(hitFromElement(elem,query)));
+    return hits;
+
+#target size of the batches of iterations handed to each worker
+ITERATION_BATCH_SIZE = 4 * 1024 * 1024
+
+def parseAllHits(source,jobs,columns=None):
+    """
+    Yields every Hit of a blast input in order
+    Files with several queries are split on their <Iteration> elements and parsed in a pool of worker processes
+    a few batches ahead of the caller, a caller that stops early doesn't wait for the rest
+    """
+    name = getattr(source,"name",None);
+    if (jobs > 1 and source is not sys.stdin and isinstance(name,str) and os.path.isfile(name)):
+        ranges,defaultQueryLength = iterationRanges(name);
+        if (len(ranges) > 1):
+            batches = [[]];
+            size = 0;
+            for start,end in ranges:
+                if (size >= ITERATION_BATCH_SIZE):
+                    batches.append([]);
+                    size = 0;
+                batches[-1].append((start,end));
+                size += end - start;
+            tasks = [(name,batch,defaultQueryLength) for batch in batches];
+            with multiprocessing.Pool(min(jobs,len(tasks))) as pool:
+                pending = collections.deque();
+                for task in tasks:
+                    pending.append(pool.apply_async(parseIterations,(task,)));
+                    if (len(pending) < jobs * 2): continue;
+                    for hit in pending.popleft().get(): yield Hit(*hit);
+                while (pending):
+                    for hit in pending.popleft().get(): yield Hit(*hit);
+            return;
+    yield from iterateHits(source,columns);
+
+def queryMatch(selector,query):
+    "Returns 'exact' when selector is the query's number or ID, 'definition' when its definition contains selector, else None"
+    if (selector in (query.get("Iteration_iter-num"),query.get("Iteration_query-ID"))): return "exact";
+    if (selector in (query.get("Iteration_query-def") or "")): return "definition";
+    return None;
+
+def queryHits(selector,hits):
+    """
+    The hits of the queries selected by --query: those whose number or ID is selector, or only when there are
+    none, those whose definition contains it. Hits matched on the definition are held back until the end of the
+    input shows that no query matches exactly, exact matches are streamed
+    """
+    exact = False;
+    held = [];
+    for hit in hits:
+        match = queryMatch(selector,hit.query);
+        if (match == "exact"):
+            exact = True;
+            held = [];
+            yield hit;
+        elif (match == "definition" and not exact):
+            held.append(hit);
+    yield from held;
 
-    if (len(results.strip()) == 0): exit(1);
-    rootNode = ET.fromstring(results);
-    alignments = rootNode.findall("BlastOutput_iterations/Iteration/Iteration_hits/Hit")
-    if (len(alignments) == 0):
-        sys.exit(0)
+def selectHits(args,hits):
+    "Applies the --query selection and the --per-query limit to a stream of hits"
+    selector = getattr(args,"query",None);
+    perQuery = getattr(args,"perQuery",None);
+    current = None;
+    count = 0;
+    if (selector is not None): hits = queryHits(selector,hits);
+    for hit in hits:
+        if (perQuery is not None):
+            key = (hit.query.get("Iteration_iter-num"),hit.query.get("Iteration_query-ID"));
+            if (key != current):
+                current = key;
+                count = 0;
+            count += 1;
+            if (count > perQuery): continue;
+        yield hit;
+
+#bump when the Hit model or the cache format changes so old caches are rebuilt
+CACHE_VERSION = 3
+CACHE_SUFFIX = ".vbcache"
+STDIN_CACHE_DIR = os.path.join(os.path.expanduser("~"),".cache","viewblast")
+#parsed piped input, by content: the least recently used go past PARSED_CACHE_SIZE bytes, all after PARSED_CACHE_TTL seconds
+PARSED_CACHE_DIR = os.path.join(STDIN_CACHE_DIR,"parsed")
+PARSED_CACHE_TTL = 30 * 86400
+PARSED_CACHE_SIZE = 512 * 1024 * 1024
+#piped input is looked up in the cache only when all of it arrives without a pause longer than STDIN_WAIT seconds
+STDIN_WAIT = 0.1
+STDIN_PEEK_SIZE = 256 * 1024 * 1024
+
+def loadCache(path,signature):
+    """
+    Returns a generator of the Hits cached in path, None when there is no cache or it is for another version or signature
+    The cache is JSON lines: a header, then a {"query":..} line before the hits of each query and a [fields,hsps] line per hit
+    """
+    try:
+        f = open(path,encoding="utf-8");
+        header = json.loads(f.readline());
+    except (OSError,ValueError):
+        return None;
+    if (not isinstance(header,dict) or header.get("version") != CACHE_VERSION or header.get("signature") != signature):
+        f.close();
+        return None;
+
+    def hits():
+        with f:
+            query = {};
+            for line in f:
+                record = json.loads(line);
+                if (isinstance(record,dict)): query = record["query"];
+                else: yield Hit(record[0],record[1],query);
+    return hits();
+
+def cachedStream(hits,tmp,signature,finish,stopped=None):
+    """
+    Yields hits while writing them to the cache file tmp, finish(tmp) is called to keep it once every hit has been
+    read. A caller that stops early leaves no cache behind but stopped() is called, and hits are streamed as before
+    when tmp can't be written
+    """
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(tmp)),exist_ok=True);
+        f = open(tmp,"w",encoding="utf-8");
+        f.write(json.dumps({"version":CACHE_VERSION,"signature":signature}) + "\n");
+    except OSError:
+        f = None;
+    writable = f is not None;
+    complete = False;
+    early = False;
+    try:
+        query = None;
+        for hit in hits:
+            if (f is not None):
+                try:
+                    if (hit.query is not query):
+                        query = hit.query;
+                        f.write(json.dumps({"query":query}) + "\n");
+                    f.write(json.dumps([hit.fields,hit.hsps]) + "\n");
+                except OSError:
+                    f.close();
+                    f = None;
+                    os.remove(tmp);
+            yield hit;
+        complete = True;
+    except GeneratorExit:
+        early = True;
+        raise
+    finally:
+        if (f is not None):
+            f.close();
+            try:
+                if (complete): finish(tmp);
+                else: os.remove(tmp);
+            except OSError:
+                pass #read only location, just don't cache
+        if (early and writable and stopped is not None): stopped();
+
+def readWaiting(stream):
+    """
+    Reads the bytes of stream that arrive without a pause longer than STDIN_WAIT, up to STDIN_PEEK_SIZE
+    Returns (data,complete), complete when the end of the input was reached. Nothing is read where select() can't wait on the stream
+    """
+    chunks = [];
+    size = 0;
+    try:
+        fd = stream.fileno();
+        while (size < STDIN_PEEK_SIZE):
+            if (not select.select([fd],[],[],STDIN_WAIT)[0]): break;
+            chunk = os.read(fd,1024 * 1024);
+            if (not chunk): return b"".join(chunks), True;
+            chunks.append(chunk);
+            size += len(chunk);
+    except (OSError,ValueError,AttributeError,io.UnsupportedOperation):
+        pass
+    return b"".join(chunks), False;
+
+class HashingReader(io.RawIOBase):
+    "A raw stream of the bytes already read from a binary stream and then the rest of it, hashing everything it returns"
+    def __init__(self,prefix,stream):
+        self.prefix = prefix;
+        self.stream = stream;
+        self.sha1 = hashlib.sha1();
+
+    def readable(self):
+        return True;
+
+    def readinto(self,buffer):
+        if (self.prefix):
+            data = self.prefix[:len(buffer)];
+            self.prefix = self.prefix[len(data):];
+        else:
+            data = self.stream.read(len(buffer));
+        buffer[:len(data)] = data;
+        self.sha1.update(data);
+        return len(data);
+
+    def hexdigest(self):
+        "The digest of the whole input, reading whatever the parser left"
+        while (self.read(1024 * 1024)): pass
+        return self.sha1.hexdigest();
+
+def parsedKey(digest,columns):
+    return util.ResultCache.key("viewblast",CACHE_VERSION,digest,columns);
+
+def loadPipedHits(blast,columns):
+    """
+    Hits of piped input: from the cache when the whole input is already waiting and was seen before, otherwise parsed
+    as it arrives and cached by its digest once it has all been read
+    """
+    if (not hasattr(blast,"buffer")): return iterateHits(blast,columns);
+    cache = util.ResultCache(PARSED_CACHE_DIR,ttl=PARSED_CACHE_TTL,maxSize=PARSED_CACHE_SIZE);
+    encoding = getattr(blast,"encoding",None) or "utf-8";
+    data,complete = readWaiting(blast);
+    if (complete):
+        key = parsedKey(hashlib.sha1(data).hexdigest(),columns);
+        path = cache.getPath(key);
+        hits = loadCache(path,None) if path else None;
+        if (hits is not None): return hits;
+        source = io.TextIOWrapper(io.BytesIO(data),encoding=encoding);
+        finalKey = lambda: key;
+    else:
+        reader = HashingReader(data,blast.buffer);
+        source = io.TextIOWrapper(io.BufferedReader(reader),encoding=encoding);
+        finalKey = lambda: parsedKey(reader.hexdigest(),columns);
+    tmp = os.path.join(PARSED_CACHE_DIR,"%d.tmp" % os.getpid());
+    return cachedStream(iterateHits(source,columns),tmp,None,lambda tmp: cache.store(finalKey(),lambda path: os.replace(tmp,path)));
+
+#contigs are stored by the sha1 of their fasta, with a small file per accession naming the digest
+CONTIG_CACHE_DIR = os.path.join(STDIN_CACHE_DIR,"contigs")
+
+def contigObjectPath(digest):
+    return os.path.join(CONTIG_CACHE_DIR,"objects",digest[:2],digest);
+
+def contigRefPath(accession):
+    return os.path.join(CONTIG_CACHE_DIR,"accessions",urllib.parse.quote(accession,safe=""));
+
+def loadCachedContig(accession):
+    try:
+        with open(contigRefPath(accession)) as f:
+            digest = f.read().strip();
+        with open(contigObjectPath(digest)) as f:
+            return f.read();
+    except OSError:
+        return None;
+
+def writeAtomically(path,text):
+    os.makedirs(os.path.dirname(path),exist_ok=True);
+    tmp = "%s.%d.tmp" % (path,os.getpid());
+    with open(tmp,"w") as f:
+        f.write(text);
+    os.replace(tmp,path);
+
+def cacheContig(accession,fasta):
+    digest = hashlib.sha1(fasta.encode("utf-8")).hexdigest();
+    try:
+        if (not os.path.exists(contigObjectPath(digest))): writeAtomically(contigObjectPath(digest),fasta);
+        writeAtomically(contigRefPath(accession),digest);
+    except OSError:
+        pass #read only location, just don't cache
+
+#a cache file being written to in the last CACHE_BUILD_TIMEOUT seconds is taken as another process building that cache
+CACHE_BUILD_TIMEOUT = 60
+
+def fileCache(name,columns):
+    "The parsed results cache of the file name and the signature it has while it is up to date"
+    st = os.stat(name);
+    #tabular files parse differently with other columns
+    return name + CACHE_SUFFIX, [st.st_size,st.st_mtime_ns,columns];
+
+def cacheBuilding(path):
+    "Whether another process is writing the cache path"
+    for tmp in glob.glob(glob.escape(path) + ".*.tmp"):
+        try:
+            if (time.time() - os.path.getmtime(tmp) < CACHE_BUILD_TIMEOUT): return True;
+        except OSError:
+            pass
+    return False;
+
+def buildCacheLater(name,columns,jobs):
+    "Starts viewblast.py cache on the file name in the background, unless its cache is already being built"
+    if (cacheBuilding(name + CACHE_SUFFIX)): return;
+    command = [sys.executable,os.path.abspath(__file__),"cache",name,"-j",str(jobs)] + (["--columns",columns] if columns else []);
+    try:
+        subprocess.Popen(command,stdin=subprocess.DEVNULL,stdout=subprocess.DEVNULL,stderr=subprocess.DEVNULL,start_new_session=True);
+    except OSError:
+        pass #no cache then
+
+def loadHits(args):
+    """
+    Returns an iterable of the Hits in args.blast, from the parsed results cache when it is up to date
+    On a cache miss the hits are streamed as they are parsed and written to the cache along the way, when the caller
+    stops early the cache is built in the background (unless args.buildCache is False)
+    """
+    columns = getattr(args,"columns",None);
+    jobs = getattr(args,"jobs",1);
+    if (not getattr(args,"cache",False)):
+        return selectHits(args,parseAllHits(args.blast,jobs,columns));
+    name = getattr(args.blast,"name",None);
+    if (args.blast is sys.stdin or not isinstance(name,str) or not os.path.isfile(name)):
+        return selectHits(args,loadPipedHits(args.blast,columns));
+    path,signature = fileCache(name,columns);
+    hits = loadCache(path,signature);
+    if (hits is None):
+        stopped = (lambda: buildCacheLater(name,columns,jobs)) if getattr(args,"buildCache",True) else None;
+        hits = cachedStream(parseAllHits(args.blast,jobs,columns),"%s.%d.tmp" % (path,os.getpid()),signature,
+                            lambda tmp: os.replace(tmp,path),stopped);
+    return selectHits(args,hits);
+
+def firstEvalue(alignment):
+    "The evalue of the first HSP as a number, None when there is none"
+    evalue = alignment.hsps[0].get("Hsp_evalue") if alignment.hsps else None;
+    return float(evalue) if evalue is not None else None;
+
+def withinEcutoff(args,alignment):
+    "Whether the hit passes -e, a hit without an evalue doesn't pass a cutoff"
+    if (not args.ecutoff): return True;
+    evalue = firstEvalue(alignment);
+    return evalue is not None and evalue <= float(args.ecutoff);
+
+def hitEvalue(args,alignment):
+    evalue = firstEvalue(alignment);
+    return str(evalue) if evalue is not None else None;
+
+def hitCoverage(args,alignment):
+    if (not alignment.queryLength): return None;
+    coverCount = calculateCoverage(alignment.hsps);
+    if (coverCount is None): return None;
+    return "{:.0f}".format(100*float(coverCount) / float(alignment.queryLength)) + "%";
+
+def hitQueryBases(args,alignment):
+    coverCount = calculateCoverage(alignment.hsps);
+    return str(coverCount) if coverCount is not None else None;
+
+def hitCoverageOfHit(args,alignment):
+    hitLength = alignment.fields.get("Hit_len");
+    coverCount = calculateHitCoverage(alignment.hsps);
+    if (not hitLength or coverCount is None): return None;
+    return "{:.0f}".format(100*float(coverCount) / float(hitLength)) + "%";
+
+def hitHspCount(args,alignment):
+    return str(len(alignment.hsps));
+
+def hitMultiframe(args,alignment):
+    isMultiframe = calculateMultiframe(args.ecutoff,alignment.hsps) if (hasattr(args,"ecutoff") and args.ecutoff is not None) else False
+    if (isMultiframe is None): return None;
+    return "MULTIFRAME" if isMultiframe else "";
+
+#format fields that are computed from the hit rather than read from it, only evaluated when a format uses them
+computedFields = {
+    "e":hitEvalue,
+    "cover":hitCoverage,
+    "cover_hit":hitCoverageOfHit,
+    "cover_q_bases":hitQueryBases,
+    "hspCount":hitHspCount,
+    "multiframe":hitMultiframe
+}
+
+#inserted for fields that a hit doesn't have
+MISSING_FIELD = "-"
+HSP_PREFIX = "Hit_hsps/Hsp/"
+
+def fieldAccessor(name,hsp=False):
+    "Returns a function (args,record) -> text or None for a format field of a Hit (or of a single Hsp map)"
+    if (hsp):
+        return lambda args,record: record.get(name);
+    if (name in computedFields):
+        return computedFields[name];
+    if (name.startswith("Iteration_")):
+        return lambda args,record: record.query.get(name);
+    if (name.startswith(HSP_PREFIX)):
+        field = name[len(HSP_PREFIX):];
+        return lambda args,record: record.hsps[0].get(field) if record.hsps else None;
+    return lambda args,record: record.fields.get(name);
+
+class Template:
+    """
+    A format string compiled once into its literal pieces and field accessors
+    eg: '{Hit_num} e:{e}' renders as "" + Hit_num + " e:" + e + ""
+    """
+    def __init__(self,formatString,hsp=False):
+        pieces = re.split("{(.*?)}",formatString.replace("\\t","\t"));
+        self.literals = pieces[0::2];
+        self.accessors = [fieldAccessor(name,hsp) for name in pieces[1::2]];
+
+    def render(self,args,record):
+        out = [self.literals[0]];
+        for accessor,literal in zip(self.accessors,self.literals[1:]):
+            value = accessor(args,record);
+            out.append(MISSING_FIELD if value is None else value);
+            out.append(literal);
+        return "".join(out);
+
+@functools.lru_cache(maxsize=None)
+def compileFormat(formatString,hsp=False):
+    return Template(formatString,hsp);
+
+def formatAlignment(args,alignment):
+    return compileFormat(args.format).render(args,alignment);
+
+def findHit(args):
+    "Returns the Hit at args.index (starting at 1), parsing only up to that hit when there is no cache"
     i = 1;
-    for alignment in alignments:
+    for alignment in loadHits(args):
         if (i == args.index):
-            hsps = alignment.findall("Hit_hsps/Hsp");
-            for hsp in hsps:
-                print(doFormat(args.format.replace("\\t","\t"),hsp,{}));
-            exit(0);
+            return alignment;
         i += 1
+    return None;
+
+def selectedHits(args):
+    "Yields (number,Hit) for the results selected by args.index in one pass over the hits, stopping after the last selected one"
+    last = None if any(l is None for f,l in args.index) else max(l for f,l in args.index);
+    i = 0;
+    for alignment in loadHits(args):
+        i += 1;
+        if (last is not None and i > last): break;
+        if (not any(f <= i and (l is None or i <= l) for f,l in args.index)): continue;
+        yield i, alignment;
+
+def hsp(args):
+    alignment = findHit(args);
+    if (alignment is None): sys.exit(0)
+    for hsp in alignment.hsps:
+        print(compileFormat(args.format,True).render(args,hsp));
+    exit(0);
 hsp_parser.set_defaults(func=hsp);
 
             
 def info(args):
-    results = args.blast.read();
+    if (args.fields is None and len(args.index) == 1 and args.index[0][0] == args.index[0][1]):
+        args.index = args.index[0][0];
+        alignment = findHit(args);
+        if (alignment is None): sys.exit(0)
+        print(formatAlignment(args,alignment));
+        exit(0);
 
-    if (len(results.strip()) == 0): exit(1);
-    rootNode = ET.fromstring(results);
-    alignments = rootNode.findall("BlastOutput_iterations/Iteration/Iteration_hits/Hit")
-    if (len(alignments) == 0):
-        sys.exit(0)
-    i = 1;
-    for alignment in alignments:
-        if (i == args.index):
-            print(formatAlignment(args,rootNode,alignment));
-            exit(0);
-        i += 1
+    for i,alignment in selectedHits(args):
+        if (args.fields is None):
+            print(formatAlignment(args,alignment));
+            continue;
+        values = [fieldAccessor(field)(args,alignment) for field in args.fields];
+        if (args.output == "json"):
+            row = {"index":i};
+            row.update(zip(args.fields,values));
+            print(json.dumps(row));
+        else:
+            print("\t".join([str(i)] + [MISSING_FIELD if v is None else v for v in values]));
+    exit(0);
 info_parser.set_defaults(func=info);
 
 def contig(args):
-    results = args.blast.read();
+    accessions = collections.OrderedDict();
+    for i,alignment in selectedHits(args):
+        if (not withinEcutoff(args,alignment)): continue;
+        accession = alignment.fields.get("Hit_accession");
+        if (accession): accessions[accession] = None;
 
-    if (len(results.strip()) == 0): exit(1);
-    rootNode = ET.fromstring(results);
-    alignments = rootNode.findall("BlastOutput_iterations/Iteration/Iteration_hits/Hit")
-    if (len(alignments) == 0):
-        sys.exit(0)
-    i = 1;
-    for alignment in alignments:
-        if (i == args.index):
-            accession = alignment.find("Hit_accession").text;
-            contig = fetchContig(accession);
-            print(contig);
-            exit(0);
-        i += 1
+    missing = [];
+    for accession in accessions:
+        accessions[accession] = loadCachedContig(accession) if args.cache else None;
+        if (accessions[accession] is None): missing.append(accession);
+    if (missing):
+        for accession,contig in fetchContigs(missing).items():
+            accessions[accession] = contig;
+            if (args.cache and contig.startswith(">")): cacheContig(accession,contig);
+
+    for contig in accessions.values():
+        print(contig);
+    exit(0);
 contig_parser.set_defaults(func=contig);
 
-def list(args):
-    results = args.blast.read();
+def keepHit(args,alignment):
+    if (not withinEcutoff(args,alignment)): return False;
+    return args.where is None or args.where(args,alignment);
 
-    if (len(results.strip()) == 0): exit(1);
-    rootNode = ET.fromstring(results);
-    alignments = rootNode.findall("BlastOutput_iterations/Iteration/Iteration_hits/Hit")
-    if (len(alignments) == 0):
-        sys.exit(0)
+def sortValue(text):
+    "Sort key of a field value: numbers before text, missing values last"
+    if (text is None): return (2,"");
+    number = numericValue(text);
+    return (0,number) if number is not None else (1,text);
 
-    output = [];
-    i = 0;
-    for alignment in alignments:
-        evalue = float(alignment.find("Hit_hsps/Hsp/Hsp_evalue").text);
+def sortKey(args):
+    "Returns (key,descending) for args.sort, key(hit) puts missing values last either way"
+    accessor,cost = filterAccessor(args.sort[0]);
+    descending = len(args.sort) == 2 and args.sort[1] == "desc";
+    if (descending):
+        def key(alignment):
+            value = sortValue(accessor(args,alignment));
+            return (value[0] != 2, value);
+    else:
+        def key(alignment):
+            return sortValue(accessor(args,alignment));
+    return key, descending;
 
-        if (args.ecutoff):
-            if (not float(evalue) <= float(args.ecutoff)): continue;
+def listedHits(args,top=None):
+    """
+    Returns the hits to list: filtered by -e and --where while streaming, before anything is formatted, then
+    ordered by --sort. Only the first top hits are kept, when sorting in a bounded heap. Equal hits keep file order
+    """
+    hits = (alignment for alignment in loadHits(args) if keepHit(args,alignment));
+    if (args.sort is None): return hits if top is None else itertools.islice(hits,top);
+    key,descending = sortKey(args);
+    if (top is not None): return (heapq.nlargest if descending else heapq.nsmallest)(top,hits,key=key);
+    return sorted(hits,key=key,reverse=descending);
 
-        fstring = formatAlignment(args,rootNode,alignment);
-        output.append(fstring.split("\t"));
+def listLimit(args):
+    "The number of results -n asks for, None for all. -n N lists N+1 results"
+    return args.max + 1 if args.max is not None and args.max >= 0 else None;
 
-        if (i == args.max): break;
-        i+=1;
+def list(args):
+    output = [];
+    for alignment in listedHits(args,listLimit(args)):
+        fstring = formatAlignment(args,alignment);
+        output.append(fstring.split("\t"));
     if (len(output)): formatTable(output);
 list_parser.set_defaults(func=list);
 
+def corpusFiles(paths,pattern):
+    "Expands directories (to their files matching the comma separated patterns) and globs to result files, leaving out the parsed results caches"
+    files = [];
+    for path in paths:
+        if (os.path.isdir(path)):
+            matches = sorted(set(itertools.chain(*[glob.glob(os.path.join(path,p.strip())) for p in pattern.split(",") if p.strip()])));
+        else:
+            matches = sorted(glob.glob(path)) or [path];
+        files.extend([f for f in matches if os.path.isfile(f) and not f.endswith((CACHE_SUFFIX,".tmp"))]);
+    return files;
+
+def corpusFile(task):
+    """
+    Worker: lists the hits of one result file as (sort key,row) pairs, the rows starting with the file and the query
+    Only the top args.max are returned, the parent merges the already sorted lists of all files. A file that isn't
+    blast results is reported (by iterateHits) and skipped
+    """
+    path,options = task;
+    args = argparse.Namespace(**options);
+    args.where = filterExpression(args.where) if args.where else None;
+    args.jobs = 1;
+    #not a background process per file of the corpus
+    args.buildCache = False;
+    key = sortKey(args)[0] if args.sort else None;
+    rows = [];
+    try:
+        with open(path) as blast:
+            args.blast = blast;
+            for alignment in listedHits(args,args.max):
+                query = alignment.query.get("Iteration_query-def") or alignment.query.get("Iteration_query-ID") or MISSING_FIELD;
+                row = "\t".join([path,query,formatAlignment(args,alignment)]);
+                rows.append((key(alignment) if key else None,row));
+    except SystemExit:
+        pass #empty or unrecognized file
+    except (ET.ParseError,ValueError,OSError) as e:
+        sys.stderr.write("%s: %s\n" % (path,e));
+    return rows;
+
+def corpus(args):
+    if (args.where):
+        try:
+            filterExpression(args.where);
+        except argparse.ArgumentTypeError as e:
+            corpus_parser.error("argument -w/--where: %s" % e);
+    if (args.max is not None and args.max < 0): corpus_parser.error("argument -n/--max: can't be negative: %d" % args.max);
+    files = corpusFiles(args.paths,args.pattern);
+    options = {name: value for name,value in vars(args).items() if name not in ("func","paths","pattern")};
+    tasks = [(path,options) for path in files];
+    jobs = max(1,min(args.jobs,len(tasks)));
+    if (jobs > 1):
+        pool = multiprocessing.Pool(jobs);
+        results = pool.imap(corpusFile,tasks,chunksize=max(1,len(tasks) // (jobs * 8)));
+    else:
+        pool = None;
+        results = (corpusFile(task) for task in tasks);
+    try:
+        if (args.sort):
+            descending = len(args.sort) == 2 and args.sort[1] == "desc";
+            rows = (row for key,row in heapq.merge(*[rows for rows in results],key=lambda pair: pair[0],reverse=descending));
+        else:
+            rows = (row for rows in results for key,row in rows);
+        for row in itertools.islice(rows,args.max):
+            print(row);
+    finally:
+        if (pool is not None): pool.terminate();
+    exit(0);
+corpus_parser.set_defaults(func=corpus);
+
+def cache(args):
+    "Parses every file whose cache is missing or out of date into its cache"
+    status = 0;
+    for name in args.files:
+        try:
+            path,signature = fileCache(name,args.columns);
+            if (loadCache(path,signature) is not None): continue;
+            with open(name) as blast:
+                for alignment in loadHits(argparse.Namespace(blast=blast,columns=args.columns,jobs=args.jobs,cache=True,buildCache=False)): pass
+        except OSError as e:
+            sys.stderr.write("%s: %s\n" % (name,e.strerror or e));
+            status = 1;
+        except SystemExit:
+            status = 1; #empty or unrecognized file, already reported
+    exit(status);
+cache_parser.set_defaults(func=cache);
+
 
 def main():
     args = parser.parse_args();